@@ -0,0 +1,376 @@
+import datetime as dt
+import decimal
+import re
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+from pymongo import MongoClient
+from pymongo.errors import ExecutionTimeout, WaitQueueTimeoutError
+
+from queries import CONFIG, PARAM_DEFAULTS, qualify
+from sketches import sketch_frame
+
+# Data access shared by the dashboard (app.py) and the headless query service
+# (query_service.py). Nothing in here imports Streamlit: callers add their own
+# caching (st.cache_resource / st.cache_data in the dashboard, an in-process
+# TTL cache in the service) and decide how to surface errors.
+
+
+def make_pg_engine(uri: str):
+    return create_engine(uri, pool_pre_ping=True, future=True)
+
+
+def make_mongo_client(uri: str, **options):
+    # Pool settings from CONFIG["mongo"]["pool"]; explicit options win.
+    return MongoClient(uri, **{**CONFIG["mongo"].get("pool", {}), **options})
+
+
+def filter_queries_by_role(qdict: dict, role: str) -> dict:
+    def ok(tags):
+        t = [s.lower() for s in (tags or ["all"])]
+        return "all" in t or role.lower() in t
+    return {name: q for name, q in qdict.items() if ok(q.get("tags"))}
+
+
+def params_context(overrides: dict | None = None) -> dict:
+    # Same shape as PARAMS_CTX in app.py. Values coming from the command line or
+    # a query string are strings, so cast them to the type of the default.
+    ctx = dict(PARAM_DEFAULTS)
+    for k, v in (overrides or {}).items():
+        default = PARAM_DEFAULTS.get(k)
+        if isinstance(default, int) and not isinstance(v, int):
+            v = int(v)
+        ctx[k] = v
+    return ctx
+
+
+def bind_params(q: dict, ctx: dict) -> dict:
+    # Only the parameters a saved query declares are passed to the driver.
+    # Time-windowed queries (see apply_time_window) also depend on "days".
+    wanted = list(q.get("params", []))
+    if (q.get("time_column") or q.get("time_field")) and "days" not in wanted:
+        wanted.append("days")
+    return {k: ctx[k] for k in wanted}
+
+
+# Time windows: a saved query with "time_column" (Postgres) or "time_field"
+# (Mongo) only looks at the last PARAMS_CTX["days"] days. The predicate is
+# injected here rather than written into each query so the saved SQL and
+# pipelines stay readable, and so partition pruning / index range scans apply
+# to every time-ordered panel. A Mongo field that holds whole days
+# ("time_granularity": "day", e.g. the daily sketches) is cut at midnight, so the
+# window keeps the day the cutoff falls in, like the raw-reading panels do.
+_CLAUSE_END = re.compile(r"\b(GROUP\s+BY|HAVING|WINDOW|ORDER\s+BY|LIMIT|OFFSET|UNION|INTERSECT|EXCEPT)\b|;",
+                         re.IGNORECASE)
+_WHERE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+
+
+def _top_level(sql: str) -> list[bool]:
+    # True for characters outside parentheses and string literals, so clauses
+    # of subqueries (e.g. `IN (SELECT ... WHERE ...)`) are not mistaken for the
+    # outer query's.
+    depth, quote, mask = 0, False, []
+    for ch in sql:
+        if ch == "'":
+            quote = not quote
+        elif not quote and ch == "(":
+            depth += 1
+        elif not quote and ch == ")":
+            depth -= 1
+        mask.append(depth == 0 and not quote)
+    return mask
+
+
+def apply_time_window(sql: str, column: str) -> str:
+    pred = f"{column} >= LOCALTIMESTAMP - make_interval(days => :days)"
+    mask = _top_level(sql)
+    where = next((m for m in _WHERE.finditer(sql) if mask[m.start()]), None)
+    start = where.end() if where else 0
+    end = next((m.start() for m in _CLAUSE_END.finditer(sql, start) if mask[m.start()]), len(sql.rstrip()))
+    if where:
+        # Parenthesise the existing condition so an OR in it can't escape the window.
+        return f"{sql[:start]} ({sql[start:end].strip()})\n            AND {pred}\n            {sql[end:]}"
+    return f"{sql[:end].rstrip()}\n            WHERE {pred}\n            {sql[end:]}"
+
+
+def window_stages(stages: list, field: str, days: int, whole_days: bool = False) -> list:
+    # A literal cutoff (instead of $$NOW) keeps the leading $match usable for
+    # index and time-series bucket pruning; flooring it to the minute keeps the
+    # pipeline, and therefore run_mongo_aggregate's cache key, stable between reruns.
+    cutoff = dt.datetime.now(dt.timezone.utc).replace(second=0, microsecond=0) - dt.timedelta(days=days)
+    if whole_days:
+        cutoff = cutoff.replace(hour=0, minute=0)
+    return [{"$match": {field: {"$gte": cutoff}}}] + list(stages)
+
+
+# Results are cached per query x parameters in every worker, so they are
+# compacted once right after the fetch: repetitive strings (alert_type,
+# device_status, elderly_id, ...) become categoricals, integer columns are
+# downcast, float columns only when float32 holds every value exactly (AVG /
+# ratio / coordinate columns stay float64), and ISO date strings are parsed
+# here instead of on every render.
+CATEGORY_MAX_RATIO = 0.5  # at most this many distinct values per row
+_ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?)?")
+_NUMBER_TYPES = (int, float, decimal.Decimal)
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    for c in df.columns:
+        s = df[c]
+        if s.dtype == object or pd.api.types.is_string_dtype(s.dtype):
+            vals = s.dropna()
+            if vals.empty:
+                continue
+            if all(isinstance(v, str) for v in vals):
+                if all(_ISO_DATE.match(v) for v in vals):
+                    try:
+                        df[c] = pd.to_datetime(s, format="ISO8601")
+                        continue
+                    except (ValueError, TypeError):
+                        pass
+                if vals.nunique() <= CATEGORY_MAX_RATIO * len(s):
+                    df[c] = s.astype("category")
+            elif all(isinstance(v, _NUMBER_TYPES) and not isinstance(v, bool) for v in vals):
+                df[c] = s.astype("float64")  # Decimal: already rounded by the query, keep every digit
+        elif pd.api.types.is_integer_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+            df[c] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s.dtype) and s.dtype != "float32":
+            f32 = s.astype("float32")
+            if ((f32.astype(s.dtype) == s) | s.isna()).all():
+                df[c] = f32
+    return df
+
+
+def frame_memory(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def fetch_pg(engine, sql: str, params: dict | None = None) -> pd.DataFrame:
+    if not isinstance(sql, str):
+        sql = str(sql)
+    with engine.connect() as conn:
+        result = conn.execute(text(sql), params or {})
+        return compact_frame(pd.DataFrame(result.fetchall(), columns=result.keys()))
+
+
+def fetch_mongo(client, db_name: str, coll: str, stages: list, sketch: dict | None = None,
+                max_time_ms: int | None = None, batch_size: int | None = None,
+                comment: str | None = None) -> pd.DataFrame:
+    # `comment` tags the server-side operation so kill_mongo_ops can find it.
+    db = client[db_name]
+    opts = {"allowDiskUse": True}
+    if max_time_ms:
+        opts["maxTimeMS"] = max_time_ms
+    if batch_size:
+        opts["batchSize"] = batch_size
+    if comment:
+        opts["comment"] = comment
+    docs = list(db[coll].aggregate(stages, **opts))
+    if sketch:
+        # `stages` selected stored sketches (see sketches.py); merge them here.
+        return compact_frame(sketch_frame(docs, sketch))
+    return compact_frame(pd.json_normalize(docs)) if docs else pd.DataFrame()
+
+
+def mongo_options(q: dict) -> dict:
+    # fetch_mongo's time budget and batch size for a saved aggregation.
+    return {"max_time_ms": q.get("max_time_ms", CONFIG["mongo"].get("max_time_ms")),
+            "batch_size": q.get("batch_size", CONFIG["mongo"].get("batch_size"))}
+
+
+def kill_mongo_ops(client, comment_prefix: str) -> int:
+    # Kills the running aggregations (and their getMores) whose comment starts
+    # with `comment_prefix`; returns how many were killed.
+    pattern = {"$regex": "^" + re.escape(comment_prefix)}
+    ops = client.admin.command({"currentOp": 1, "$or": [{"command.comment": pattern},
+                                                        {"originatingCommand.comment": pattern}]})
+    n = 0
+    for op in ops.get("inprog", []):
+        client.admin.command("killOp", op=op["opid"])
+        n += 1
+    return n
+
+
+# Degraded results: when a query runs over its time budget (or no pooled
+# connection frees up in time), serve the last result it produced instead of
+# an error. Unlike the TTL caches, these never expire; they are only replaced.
+DEGRADED_ERRORS = (ExecutionTimeout, WaitQueueTimeoutError)
+
+
+class LastResults:
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: tuple, df: pd.DataFrame):
+        with self._lock:
+            self._frames.pop(key, None)
+            self._frames[key] = (time.time(), df)
+            while len(self._frames) > self.max_entries:
+                del self._frames[next(iter(self._frames))]
+
+    def get(self, key: tuple):
+        with self._lock:
+            return self._frames.get(key)
+
+
+def fetch_with_fallback(store: LastResults, key: tuple, fetch) -> tuple[pd.DataFrame, float | None]:
+    # (fresh result, None), or (last good result, its age in seconds) when
+    # `fetch` exceeds its budget. Without an earlier result the error propagates.
+    try:
+        df = fetch()
+    except DEGRADED_ERRORS:
+        hit = store.get(key)
+        if hit is None:
+            raise
+        return hit[1], time.time() - hit[0]
+    store.put(key, df)
+    return df, None
+
+
+# Chart pushdown: a chart spec with "pushdown": True has its heatmap pivot or
+# bar aggregation done by the database, so only the final matrix / one row per
+# bar comes back instead of the full long-format result. "agg" picks the
+# aggregate (default "mean", matching the pivot_table call in render_chart).
+# Only the dashboard asks for it (chart=True below): everything else -- the
+# headless CLI / API, plan checks of the saved queries -- gets the saved
+# query's own rows.
+PG_AGGS = {"mean": "AVG", "sum": "SUM", "min": "MIN", "max": "MAX", "count": "COUNT"}
+MONGO_AGGS = {"mean": "$avg", "sum": "$sum", "min": "$min", "max": "$max"}
+
+
+def _ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _as_list(v) -> list:
+    return list(v) if isinstance(v, (list, tuple)) else [v]
+
+
+def pushdown_sql(sql: str, spec: dict) -> tuple[str, dict]:
+    if not spec.get("pushdown") or spec.get("type") not in ("heatmap", "bar"):
+        return sql, {}
+    agg = PG_AGGS[spec.get("agg", "mean")]
+    src = "WITH src AS (\n" + sql.strip().rstrip(";") + "\n)\n"
+    if spec["type"] == "bar":
+        keys = [_ident(c) for c in [spec["x"], spec.get("color")] if c]
+        ys = ", ".join(f"{agg}({_ident(y)}) AS {_ident(y)}" for y in _as_list(spec["y"]))
+        group = ", ".join(dict.fromkeys(keys))
+        return src + f"SELECT {group}, {ys} FROM src GROUP BY {group} ORDER BY {group}", {}
+
+    rows, cols, vals = _ident(spec["rows"]), _ident(spec["cols"]), _ident(spec["values"])
+    if spec.get("col_values"):
+        # Known columns: a plain FILTER pivot, one output column per value.
+        params = {f"pd_c{i}": v for i, v in enumerate(spec["col_values"])}
+        cells = ", ".join(f"{agg}({vals}) FILTER (WHERE {cols} = :pd_c{i}) AS {_ident(str(v))}"
+                          for i, v in enumerate(spec["col_values"]))
+        return src + f"SELECT {rows}, {cells} FROM src GROUP BY {rows} ORDER BY {rows}", params
+    # Unknown columns: aggregate per cell, then fold each row's cells into one
+    # JSON object; expand_pivot() turns those into columns.
+    return src + (
+        f"SELECT {rows}, json_object_agg(c, v) AS pivot_cells FROM ("
+        f"SELECT {rows}, {cols}::text AS c, {agg}({vals}) AS v FROM src "
+        f"WHERE {cols} IS NOT NULL GROUP BY {rows}, {cols}) cells "
+        f"GROUP BY {rows} ORDER BY {rows}"
+    ), {}
+
+
+def pushdown_stages(stages: list, spec: dict) -> list:
+    if not spec.get("pushdown") or spec.get("type") not in ("heatmap", "bar"):
+        return stages
+    agg = spec.get("agg", "mean")
+
+    def acc(field):
+        return {"$sum": 1} if agg == "count" else {MONGO_AGGS[agg]: f"${field}"}
+
+    if spec["type"] == "bar":
+        keys = list(dict.fromkeys(c for c in [spec["x"], spec.get("color")] if c))
+        ys = _as_list(spec["y"])
+        return stages + [
+            {"$group": {"_id": {f"k{i}": f"${k}" for i, k in enumerate(keys)},
+                        **{f"y{i}": acc(y) for i, y in enumerate(ys)}}},
+            {"$project": {"_id": 0, **{k: f"$_id.k{i}" for i, k in enumerate(keys)},
+                          **{y: f"$y{i}" for i, y in enumerate(ys)}}},
+            {"$sort": {k: 1 for k in keys}},
+        ]
+    rows, cols = spec["rows"], spec["cols"]
+    return stages + [
+        {"$match": {cols: {"$ne": None}}},
+        {"$group": {"_id": {"r": f"${rows}", "c": f"${cols}"}, "v": acc(spec["values"])}},
+        {"$group": {"_id": "$_id.r", "cells": {"$push": {"k": {"$toString": "$_id.c"}, "v": "$v"}}}},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": [{rows: "$_id"}, {"$arrayToObject": "$cells"}]}}},
+        {"$sort": {rows: 1}},
+    ]
+
+
+def expand_pivot(df: pd.DataFrame) -> pd.DataFrame:
+    if "pivot_cells" not in df.columns:
+        return df
+    cells = compact_frame(pd.DataFrame.from_records(list(df["pivot_cells"]), index=df.index))
+    return pd.concat([df.drop(columns="pivot_cells"), cells], axis=1)
+
+
+def pg_statement(q: dict, ctx: dict, chart: bool = False) -> tuple[str, dict]:
+    sql = qualify(q["sql"])
+    if q.get("time_column"):
+        sql = apply_time_window(sql, q["time_column"])
+    extra = {}
+    if chart:
+        sql, extra = pushdown_sql(sql, q.get("chart", {}))
+    return sql, {**bind_params(q, ctx), **extra}
+
+
+def mongo_pipeline(q: dict, ctx: dict, chart: bool = False) -> list:
+    stages = q["aggregate"]
+    if q.get("time_field"):
+        stages = window_stages(stages, q["time_field"], ctx["days"], q.get("time_granularity") == "day")
+    return pushdown_stages(stages, q.get("chart", {})) if chart else stages
+
+
+# Federated queries (CONFIG["federated"]): the Mongo side runs like any saved
+# aggregation, then each entry of "joins" hash-joins a cached Postgres
+# dimension onto it with DataFrame.merge.
+DIMENSION_TTL = 300  # seconds between reloads of a dimension table
+
+
+class DimensionCache:
+    # Dimension tables per (Postgres URI, name), shared by every session of a
+    # worker. A stale entry is reloaded by the first caller that needs it.
+    def __init__(self, ttl: float = DIMENSION_TTL):
+        self.ttl = ttl
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def get(self, engine, name: str) -> pd.DataFrame:
+        key = (str(engine.url), name)
+        with self._lock:
+            hit = self._frames.get(key)
+        if hit and time.monotonic() - hit[0] < self.ttl:
+            return hit[1]
+        df = fetch_pg(engine, qualify(CONFIG["federated"]["dimensions"][name]))
+        with self._lock:
+            self._frames[key] = (time.monotonic(), df)
+        return df
+
+
+def federated_join(left: pd.DataFrame, q: dict, ctx: dict, load_dimension) -> pd.DataFrame:
+    out = left
+    for j in q.get("joins", []):
+        left_on, right_on = j["on"]
+        if left_on not in out.columns:
+            return out  # no Mongo rows, nothing to join
+        dim = load_dimension(j["dimension"])
+        for col, key in j.get("where", {}).items():
+            dim = dim[dim[col] == ctx[key]]
+        # Join on plain strings: the two sides may be categoricals with different categories.
+        out = out.assign(**{left_on: out[left_on].astype(str)}).merge(
+            dim.assign(**{right_on: dim[right_on].astype(str)}),
+            how=j.get("how", "inner"), left_on=left_on, right_on=right_on,
+            suffixes=("", f"_{j['dimension']}"),
+        )
+        if right_on != left_on:
+            out = out.drop(columns=right_on)
+    return compact_frame(out)
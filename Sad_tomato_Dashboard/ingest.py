@@ -0,0 +1,365 @@
+import argparse
+import csv
+import datetime as dt
+import io
+import json
+import queue
+import random
+import socketserver
+import sys
+import threading
+import time
+
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from queries import CONFIG, PG_SCHEMA
+from backend import make_mongo_client, make_pg_engine
+
+# Bulk ingestion of device telemetry and alerts.
+#
+#   python ingest.py --to mongo --collection sensor_readings < readings.jsonl
+#   python ingest.py --to mongo --collection alert_readings --tail /var/log/alerts.jsonl
+#   python ingest.py --to mongo --collection sensor_readings --listen 127.0.0.1:9009
+#   python ingest.py --to postgres --synthetic 100000 --batch-size 5000
+#
+# Every source yields one JSON document per line. Mongo documents keep the
+# shape of the bundled dumps (sensor_readings / alert_readings / device); ISO
+# strings in "ts" / "timestamp" become dates so the time windows apply to them.
+# Postgres records carry the `alerts` columns plus any of the `alert_vitals`
+# columns and are written with COPY, alerts and vitals in one transaction.
+#
+# Records go through a bounded queue: when the writer falls behind, put()
+# blocks, which stalls the file reader or stops reading from the socket
+# (so TCP pushes back on the device gateway) instead of growing memory.
+#
+# A batch that fails with a connection-level error is retried with exponential
+# backoff (--retries); the writer blocks meanwhile, so the same backpressure
+# applies. Batches that still fail, or fail on their data (a bad value), and
+# the single documents Mongo refuses (a duplicate key) are appended to
+# --failed-file as JSON lines, which this script reads back with --file once
+# the cause is fixed. _ids the driver gave them are left out, so a replay gets
+# fresh ones and the _id-ordered readers (sketches.py, rules.py) pick it up.
+
+PG_ALERT_COLUMNS = ["alert_id", "elderly_id", "device_id", "alert_timestamp", "alert_type", "alert_status"]
+PG_VITAL_COLUMNS = ["heart_rate_at_alert", "blood_pressure_at_alert", "oxygen_saturation_at_alert",
+                    "glucose_level_at_alert"]
+TIME_FIELDS = ("ts", "timestamp")
+DUPLICATE_KEY = 11000
+
+
+class Rejected(Exception):
+    # A sink wrote part of a batch and refused the records at `indices` on
+    # their data; the rest of the batch needs no retry.
+    def __init__(self, written: int, indices: list[int], first_error: str):
+        super().__init__(f"{len(indices)} records rejected, first: {first_error}")
+        self.written = written
+        self.indices = indices
+
+
+def parse_record(line: str) -> dict | None:
+    line = line.strip()
+    if not line:
+        return None
+    doc = json.loads(line)
+    for f in TIME_FIELDS:
+        v = doc.get(f)
+        if isinstance(v, dict) and "$date" in v:
+            v = v["$date"]
+        if isinstance(v, str):
+            doc[f] = dt.datetime.fromisoformat(v.replace("Z", "+00:00"))
+    return doc
+
+
+class MongoSink:
+    transient = (ConnectionFailure,)  # network errors, failovers, server selection timeouts
+
+    def __init__(self, uri: str, db_name: str, collection: str):
+        self.coll = make_mongo_client(uri)[db_name][collection]
+
+    def write(self, batch: list[dict], retry: bool = False) -> int:
+        # Unordered: one bad document (e.g. a duplicate _id) doesn't stop the rest.
+        try:
+            return len(self.coll.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            written, errors = e.details.get("nInserted", 0), e.details.get("writeErrors", [])
+            if retry:
+                # A retried batch keeps the _ids insert_many gave it the first
+                # time, so documents that got in before the connection dropped
+                # come back as duplicates: they are written, not rejected.
+                written += sum(x.get("code") == DUPLICATE_KEY for x in errors)
+                errors = [x for x in errors if x.get("code") != DUPLICATE_KEY]
+            if not errors:
+                return written
+            raise Rejected(written, [x["index"] for x in errors], errors[0].get("errmsg", "?"))
+
+
+class PostgresAlertSink:
+    def __init__(self, uri: str):
+        import psycopg2  # COPY goes through the raw psycopg2 connection
+
+        self.transient = (OperationalError, psycopg2.OperationalError)
+        self.engine = make_pg_engine(uri)
+        # After `partitioning.py postgres`, alert_vitals carries alert_timestamp
+        # for its (alert_id, alert_timestamp) foreign key into alerts.
+        with self.engine.connect() as conn:
+            has_ts = conn.execute(text(
+                "SELECT 1 FROM information_schema.columns WHERE table_schema = :schema "
+                "AND table_name = 'alert_vitals' AND column_name = 'alert_timestamp'"
+            ), {"schema": PG_SCHEMA}).scalar()
+        self.vital_columns = ["alert_id"] + (["alert_timestamp"] if has_ts else []) + PG_VITAL_COLUMNS
+
+    def next_alert_id(self) -> int:
+        with self.engine.connect() as conn:
+            return conn.execute(text(
+                f"SELECT GREATEST((SELECT max(alert_id) FROM {PG_SCHEMA}.alerts), "
+                f"(SELECT max(alert_id) FROM {PG_SCHEMA}.alert_vitals), 0) + 1"
+            )).scalar()
+
+    @staticmethod
+    def to_csv(rows: list[dict], columns: list[str]) -> io.StringIO:
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        for r in rows:
+            # Empty unquoted field is NULL in COPY's csv format.
+            w.writerow(["" if r.get(c) is None else r[c] for c in columns])
+        buf.seek(0)
+        return buf
+
+    def write(self, batch: list[dict], retry: bool = False) -> int:
+        vitals = [r for r in batch if any(r.get(c) is not None for c in PG_VITAL_COLUMNS)]
+        raw = self.engine.raw_connection()
+        try:
+            with raw.cursor() as cur:
+                cur.copy_expert(f"COPY {PG_SCHEMA}.alerts ({', '.join(PG_ALERT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                                self.to_csv(batch, PG_ALERT_COLUMNS))
+                if vitals:
+                    cols = self.vital_columns
+                    cur.copy_expert(f"COPY {PG_SCHEMA}.alert_vitals ({', '.join(cols)}) FROM STDIN WITH (FORMAT csv)",
+                                    self.to_csv(vitals, cols))
+            raw.commit()
+        except Exception:
+            raw.rollback()
+            raise
+        finally:
+            raw.close()
+        return len(batch)
+
+
+class Batcher:
+    # Collects records from any number of producer threads and hands them to
+    # `sink.write` in batches of `batch_size`, or whatever has arrived after
+    # `flush_interval` seconds, from a single writer thread.
+    def __init__(self, sink, batch_size: int = 1000, flush_interval: float = 1.0, max_pending: int = 10000,
+                 report_every: float = 5.0, retries: int = 8, failed_file: str | None = "ingest_failed.jsonl"):
+        self.sink = sink
+        self.retries = retries
+        self.failed_file = failed_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.report_every = report_every
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.received = self.written = self.batches = self.failed = self.retried = 0
+        self._count_lock = threading.Lock()
+        self.started = time.monotonic()
+        self._done = object()
+        self._writer = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self._writer.start()
+
+    def put(self, record: dict):
+        self.pending.put(record)  # blocks while the queue is full
+        with self._count_lock:
+            self.received += 1
+
+    def close(self):
+        self.pending.put(self._done)
+        self._writer.join()
+
+    def _flush(self, batch: list[dict]):
+        transient = getattr(self.sink, "transient", ())
+        # insert_many adds an _id to the documents that have none; remember
+        # which, so a saved copy goes without it.
+        fresh = {id(rec) for rec in batch if "_id" not in rec}
+        for attempt in range(self.retries + 1):
+            try:
+                self.written += self.sink.write(batch, retry=attempt > 0)
+                break
+            except Rejected as e:
+                self.written += e.written
+                self._give_up([batch[i] for i in e.indices], e, fresh)
+                break
+            except transient as e:
+                if attempt == self.retries:
+                    self._give_up(batch, e, fresh)
+                    break
+                delay = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"ingest: batch of {len(batch)} failed ({e}); retry {attempt + 1}/{self.retries} "
+                      f"in {delay:.1f}s", file=sys.stderr)
+                self.retried += 1
+                time.sleep(delay)
+            except Exception as e:
+                self._give_up(batch, e, fresh)
+                break
+        self.batches += 1
+
+    def _give_up(self, records: list[dict], error: Exception, fresh: set):
+        self.failed += len(records)
+        where = "dropped"
+        if self.failed_file:
+            with open(self.failed_file, "a", encoding="utf-8") as fh:
+                for rec in records:
+                    if id(rec) in fresh:
+                        rec = {k: v for k, v in rec.items() if k != "_id"}
+                    fh.write(json.dumps(rec, default=str, ensure_ascii=False) + "\n")
+            where = f"saved to {self.failed_file}"
+        print(f"ingest: {len(records)} records failed: {error}; {where}", file=sys.stderr)
+
+    def _run(self):
+        batch, deadline, next_report = [], time.monotonic() + self.flush_interval, time.monotonic()
+        while True:
+            try:
+                item = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is not None and item is not self._done:
+                batch.append(item)
+            now = time.monotonic()
+            if batch and (len(batch) >= self.batch_size or now >= deadline or item is self._done):
+                self._flush(batch)
+                batch = []
+            if now >= deadline:
+                deadline = now + self.flush_interval
+            if self.report_every and now >= next_report + self.report_every:
+                print(self.summary(), file=sys.stderr)
+                next_report = now
+            if item is self._done:
+                return
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"ingest: {self.written:,} written / {self.received:,} received in {self.batches:,} batches, "
+                f"{self.failed:,} failed, {self.retried:,} retries, {self.written / elapsed:,.0f} records/s, "
+                f"{self.pending.qsize():,} queued")
+
+
+def read_lines(fh):
+    for n, line in enumerate(fh, 1):
+        try:
+            rec = parse_record(line)
+        except ValueError as e:
+            print(f"ingest: skipping bad line {n}: {e}", file=sys.stderr)
+            continue
+        if rec is not None:
+            yield rec
+
+
+def tail_file(path: str, poll: float = 0.5):
+    # Follows a growing file from its current end, like `tail -f`.
+    with open(path, encoding="utf-8") as fh:
+        fh.seek(0, io.SEEK_END)
+        buf = ""
+        while True:
+            chunk = fh.readline()
+            if not chunk:
+                time.sleep(poll)
+                continue
+            buf += chunk
+            if buf.endswith("\n"):
+                line, buf = buf, ""
+                yield from read_lines([line])
+
+
+def synthetic_records(n: int, target: str, first_alert_id: int = 1):
+    # Readings / alerts in the shape of the bundled dumps, for throughput tests
+    # against local databases. Alert ids continue after the existing ones.
+    now = dt.datetime.now(dt.timezone.utc)
+    for i in range(n):
+        ts = now - dt.timedelta(seconds=n - i)
+        if target == "postgres":
+            hr = random.randint(50, 140)
+            yield {"alert_id": first_alert_id + i, "elderly_id": random.randint(1, 50),
+                   "device_id": f"D{random.randint(1, 50):03d}", "alert_timestamp": ts.replace(tzinfo=None),
+                   "alert_type": random.choice(["fall", "heart rate", "glucose"]), "alert_status": "triggered",
+                   "heart_rate_at_alert": hr, "blood_pressure_at_alert": f"{random.randint(100, 150)}/80 mmHg",
+                   "oxygen_saturation_at_alert": random.randint(88, 100),
+                   "glucose_level_at_alert": random.randint(70, 180)}
+        else:
+            hr = random.randint(45, 140)
+            yield {"ts": ts, "device_id": f"wb-{random.randint(1, 20):03d}",
+                   "elderly_id": f"ELDERLY_{random.randint(1001, 1020)}",
+                   "vital_signs": {"heart_rate": hr, "blood_pressure": f"{random.randint(100, 150)}/80",
+                                   "oxygen_level": round(random.uniform(88, 100), 1),
+                                   "body_temperature": round(random.uniform(36, 38.5), 1),
+                                   "glucose_level": round(random.uniform(4, 10), 1)},
+                   "is_abnormal": hr > 120 or hr < 50}
+
+
+def serve_socket(host: str, port: int, batcher: Batcher):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                try:
+                    rec = parse_record(raw.decode("utf-8"))
+                except ValueError as e:
+                    print(f"ingest: skipping bad line from {self.client_address[0]}: {e}", file=sys.stderr)
+                    continue
+                if rec is not None:
+                    batcher.put(rec)
+
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"ingest: listening on {host}:{port}", file=sys.stderr)
+    server.serve_forever()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Batch-load readings and alerts into Mongo or Postgres.")
+    p.add_argument("--to", choices=["mongo", "postgres"], required=True)
+    p.add_argument("--collection", default="sensor_readings", help="Mongo collection (--to mongo)")
+    p.add_argument("--pg-uri", default=CONFIG["postgres"]["uri"])
+    p.add_argument("--mongo-uri", default=CONFIG["mongo"]["uri"])
+    p.add_argument("--mongo-db", default=CONFIG["mongo"]["db_name"])
+    src = p.add_mutually_exclusive_group()
+    src.add_argument("--file", help="JSON lines file ('-' or omitted: stdin)")
+    src.add_argument("--tail", metavar="FILE", help="follow a growing JSON lines file")
+    src.add_argument("--listen", metavar="HOST:PORT", help="accept JSON lines over TCP")
+    src.add_argument("--synthetic", type=int, metavar="N", help="generate N records")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.add_argument("--flush-interval", type=float, default=1.0, help="seconds")
+    p.add_argument("--max-pending", type=int, default=10000, help="queued records before producers block")
+    p.add_argument("--report-every", type=float, default=5.0, help="seconds between throughput reports, 0 = off")
+    p.add_argument("--retries", type=int, default=8, help="retries of a batch after a connection error")
+    p.add_argument("--failed-file", default="ingest_failed.jsonl",
+                   help="JSON lines file for batches that could not be written ('' = drop them)")
+    args = p.parse_args(argv)
+
+    sink = (PostgresAlertSink(args.pg_uri) if args.to == "postgres"
+            else MongoSink(args.mongo_uri, args.mongo_db, args.collection))
+    batcher = Batcher(sink, args.batch_size, args.flush_interval, args.max_pending, args.report_every,
+                      args.retries, args.failed_file or None)
+    try:
+        if args.listen:
+            host, _, port = args.listen.rpartition(":")
+            serve_socket(host or "127.0.0.1", int(port), batcher)
+        else:
+            if args.synthetic:
+                first_id = sink.next_alert_id() if args.to == "postgres" else 1
+                records = synthetic_records(args.synthetic, args.to, first_id)
+            elif args.tail:
+                records = tail_file(args.tail)
+            elif args.file and args.file != "-":
+                records = read_lines(open(args.file, encoding="utf-8"))
+            else:
+                records = read_lines(sys.stdin)
+            for rec in records:
+                batcher.put(rec)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.close()
+        print(batcher.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import websockets
+from pymongo import monitoring
+from pymongo.monitoring import ConnectionCheckOutFailedReason
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.web import cli as streamlit_cli
+
+from queries import CONFIG, PARAM_DEFAULTS, ROLES
+from backend import filter_queries_by_role
+
+# Drives N concurrent simulated dashboard sessions against one real
+# `streamlit run app.py` server, to see how many clinicians a single worker
+# serves before its Postgres pool or Mongo client saturates.
+#
+#   python loadtest.py --sessions 20 --duration 120
+#   python loadtest.py --sessions 50 --mix medical_worker=5,emergency_contact=3,elderly=2 --think 2
+#   python loadtest.py --sessions 10 --iterations 20 --json report.json
+#
+# Run it against locally restored copies of the bundled dumps (point PG_URI /
+# MONGO_URI in .env, or --pg-uri / --mongo-uri, at them), never production.
+#
+# The harness starts the server itself (`python loadtest.py --serve ...`, on
+# --port) with pool instrumentation installed in it, and talks to it over the
+# websocket protocol the browser uses, one connection per session. So the
+# sessions share the worker's st.cache_resource engines / clients and
+# st.cache_data results the way real users do, and a sidebar edit or a Run
+# click reruns the whole script or just that panel's fragment, as in a browser.
+#
+# Each session picks a role from --mix, fills in the sidebar parameters
+# (PARAMS_CTX) for it, then repeatedly picks a panel and a saved query for that
+# role and presses Run. Reported:
+#   throughput        completed Run clicks per second, all sessions together
+#   latency           p50 / p90 / p99 / max per panel, in ms
+#   pool wait         time the worker spent waiting for a Postgres (QueuePool)
+#                     or Mongo pool connection, and how often that wait timed out
+#   memory            the worker's resident set before / after / peak, and its
+#                     growth per session
+
+DEFAULT_MIX = {"medical_worker": 4, "emergency_contact": 3, "elderly": 2, "system_administrator": 1}
+PANELS = {  # panel -> (query selectbox label, run button label, CONFIG section, weight)
+    "postgres": ("Choose a saved query", "▶ Run Postgres", "postgres", 6),
+    "mongo": ("Choose a saved aggregation", "▶ Run Mongo", "mongo", 3),
+    "federated": ("Choose a saved cross-store query", "▶ Run cross-store", "federated", 1),
+}
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+class PoolWaits:
+    # Time spent waiting for pooled connections, from the Mongo driver's
+    # connection pool events and a wrapper around QueuePool checkouts.
+    def __init__(self):
+        self.samples = {"postgres": [], "mongo": []}
+        self.timeouts = {"postgres": 0, "mongo": 0}
+        self._lock = threading.Lock()
+
+    def add(self, backend: str, seconds: float | None, timed_out: bool = False):
+        with self._lock:
+            if seconds is not None:
+                self.samples[backend].append(seconds)
+            self.timeouts[backend] += timed_out
+
+    def install(self):
+        waits = self
+        do_get = QueuePool._do_get
+
+        def timed_do_get(pool):
+            started = time.perf_counter()
+            try:
+                conn = do_get(pool)
+            except PoolTimeout:
+                waits.add("postgres", time.perf_counter() - started, timed_out=True)
+                raise
+            waits.add("postgres", time.perf_counter() - started)
+            return conn
+
+        QueuePool._do_get = timed_do_get
+
+        class MongoPoolListener(monitoring.ConnectionPoolListener):
+            def connection_checked_out(self, event):
+                waits.add("mongo", event.duration)
+
+            def connection_check_out_failed(self, event):
+                waits.add("mongo", event.duration, timed_out=event.reason == ConnectionCheckOutFailedReason.TIMEOUT)
+
+            # The remaining pool events are not needed here.
+            def pool_created(self, event): pass
+            def pool_ready(self, event): pass
+            def pool_cleared(self, event): pass
+            def pool_closed(self, event): pass
+            def connection_created(self, event): pass
+            def connection_ready(self, event): pass
+            def connection_closed(self, event): pass
+            def connection_check_out_started(self, event): pass
+            def connection_checked_in(self, event): pass
+
+        # Clients created after this (app.py creates its own lazily) report to it.
+        monitoring.register(MongoPoolListener())
+
+
+def rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        role, _, weight = part.partition("=")
+        role = role.strip()
+        if role not in ROLES:
+            raise argparse.ArgumentTypeError(f"unknown role {role!r}, expected one of {', '.join(ROLES)}")
+        mix[role] = float(weight or 1)
+    return mix
+
+
+def session_params(rng: random.Random, ids: int) -> dict:
+    # A PARAMS_CTX for one simulated user: their own ids, the rest as defaults.
+    ctx = dict(PARAM_DEFAULTS)
+    for k in ("elderly_id", "medical_worker_id", "emergency_contact_id"):
+        ctx[k] = rng.randint(1, ids)
+    ctx["days"] = rng.choice([7, 7, 30, 90])
+    return ctx
+
+
+class Session:
+    # One browser tab: a websocket to the server, and the widget values the
+    # frontend would send along with every rerun.
+    def __init__(self, n: int, role: str, args, results: list):
+        self.n = n
+        self.role = role
+        self.args = args
+        self.results = results
+        self.rng = random.Random(args.seed + n)
+        self.ctx = session_params(self.rng, args.ids)
+        self.widgets = {}  # label -> (widget id, fragment id, options) as last rendered
+        self.values = {}  # widget id -> (WidgetState field, value)
+
+    def set(self, label: str, field: str, value):
+        self.values[self.widgets[label][0]] = (field, value)
+
+    async def receive(self, ws) -> int:
+        # Reads the rerun's messages up to script_finished; returns how many
+        # errors (st.error / exceptions) it rendered.
+        errors = 0
+        while True:
+            msg = ForwardMsg()
+            msg.ParseFromString(await ws.recv())
+            kind = msg.WhichOneof("type")
+            if kind == "script_finished":
+                return errors
+            if kind != "delta" or msg.delta.WhichOneof("type") != "new_element":
+                continue
+            element = msg.delta.new_element
+            etype = element.WhichOneof("type")
+            proto = getattr(element, etype)
+            if getattr(proto, "id", ""):
+                self.widgets[proto.label] = (proto.id, msg.delta.fragment_id, list(getattr(proto, "options", [])))
+            errors += etype == "exception" or (etype == "alert" and proto.format == Alert.ERROR)
+
+    async def rerun(self, ws, action: str, fragment: str = "", trigger: str | None = None):
+        msg = BackMsg()
+        msg.rerun_script.fragment_id = fragment
+        states = dict(self.values)
+        if trigger:
+            states[trigger] = ("trigger_value", True)
+        for wid, (field, value) in states.items():
+            state = msg.rerun_script.widget_states.widgets.add()
+            state.id = wid
+            if field == "double_array_value":
+                state.double_array_value.data.extend(value)
+            else:
+                setattr(state, field, value)
+        started = time.perf_counter()
+        await ws.send(msg.SerializeToString())
+        errors = await asyncio.wait_for(self.receive(ws), self.args.timeout)
+        self.results.append({"session": self.n, "role": self.role, "action": action,
+                             "seconds": time.perf_counter() - started, "errors": errors, "at": time.time()})
+
+    async def start(self, ws):
+        await self.rerun(ws, "load")
+        self.set("Postgres URI", "string_value", self.args.pg_uri)
+        self.set("Mongo URI", "string_value", self.args.mongo_uri)
+        self.set("Mongo DB name", "string_value", self.args.mongo_db)
+        self.set("User role", "string_value", self.role)
+        for k in ("elderly_id", "medical_worker_id", "emergency_contact_id"):
+            self.set(k, "double_value", float(self.ctx[k]))
+        self.set("last N days", "double_array_value", [float(self.ctx["days"])])
+        await self.rerun(ws, "sidebar")
+
+    def candidates(self, section: str) -> list[str]:
+        qdict = CONFIG[section]["queries"]
+        # The Postgres panel lists only the role's queries; the Mongo panels list
+        # everything, so a user still mostly opens the ones tagged for them.
+        return list(filter_queries_by_role(qdict, self.role)) or list(qdict)
+
+    async def step(self, ws):
+        panels = [p for p in PANELS if CONFIG[PANELS[p][2]].get("enabled", True)]
+        panel = self.rng.choices(panels, [PANELS[p][3] for p in panels])[0]
+        sel_label, run_label, section, _ = PANELS[panel]
+        if sel_label not in self.widgets or run_label not in self.widgets:
+            return  # the panel failed before rendering its controls
+        names = [n for n in self.candidates(section) if n in self.widgets[sel_label][2]]
+        if not names:
+            return
+        self.set(sel_label, "string_value", self.rng.choice(names))
+        run_id, fragment, _ = self.widgets[run_label]
+        # A Run click only reruns the panel's fragment, as in the browser.
+        await self.rerun(ws, panel, fragment=fragment, trigger=run_id)
+
+    async def run(self, url: str, deadline: float):
+        try:
+            async with websockets.connect(url, subprotocols=["streamlit"], max_size=None) as ws:
+                await self.start(ws)
+                done = 0
+                while time.time() < deadline and (not self.args.iterations or done < self.args.iterations):
+                    if self.args.think:
+                        await asyncio.sleep(self.rng.expovariate(1 / self.args.think))
+                    await self.step(ws)
+                    done += 1
+        except Exception as e:  # e.g. a rerun over --timeout; the other sessions carry on
+            print(f"loadtest: session {self.n} ({self.role}) stopped: {e!r}", file=sys.stderr)
+
+
+async def run_sessions(roles: list[str], args, results: list, deadline: float):
+    url = f"ws://127.0.0.1:{args.port}/_stcore/stream"
+    step = args.ramp / max(len(roles), 1)
+
+    async def session(n: int, role: str):
+        await asyncio.sleep(n * step)
+        await Session(n, role, args, results).run(url, deadline)
+
+    await asyncio.gather(*(session(n, role) for n, role in enumerate(roles)))
+
+
+def serve(stats_path: str, port: int):
+    # Entry point of the server process: app.py under `streamlit run`, with
+    # the pool instrumentation installed and its numbers (plus the process's
+    # memory) written to stats_path every second for the harness to read.
+    waits = PoolWaits()
+    waits.install()
+
+    def dump():
+        while True:
+            with waits._lock:
+                stats = {"waits": {b: list(w) for b, w in waits.samples.items()}, "timeouts": dict(waits.timeouts)}
+            stats.update(rss=rss_bytes(), rss_peak=peak_rss_bytes())
+            with open(stats_path + ".tmp", "w", encoding="utf-8") as fh:
+                json.dump(stats, fh)
+            os.replace(stats_path + ".tmp", stats_path)
+            time.sleep(1)
+
+    threading.Thread(target=dump, daemon=True).start()
+    sys.argv = ["streamlit", "run", APP, "--server.port", str(port), "--server.headless", "true",
+                "--server.fileWatcherType", "none", "--browser.gatherUsageStats", "false"]
+    streamlit_cli.main()
+
+
+def start_server(port: int, stats_path: str, log) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", stats_path, "--port", str(port)],
+                            stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(APP))
+    deadline = time.time() + 60
+    while time.time() < deadline and proc.poll() is None:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=2) as resp:
+                if resp.status == 200 and os.path.exists(stats_path):
+                    return proc
+        except OSError:
+            pass
+        time.sleep(0.5)
+    stop_server(proc)
+    log.seek(0)
+    raise SystemExit("loadtest: the app server didn't start:\n" + log.read()[-2000:])
+
+
+def stop_server(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def read_stats(path: str) -> dict:
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def percentiles(seconds: list[float]) -> dict:
+    if not seconds:
+        return {}
+    ms = np.array(seconds) * 1000
+    return {"n": len(ms), "p50": np.percentile(ms, 50), "p90": np.percentile(ms, 90),
+            "p99": np.percentile(ms, 99), "max": ms.max()}
+
+
+def build_report(results: list[dict], before: dict, after: dict, elapsed: float, args) -> dict:
+    runs = [r for r in results if r["action"] in PANELS]
+    # Only what the worker recorded while the sessions ran.
+    waits = {b: after["waits"][b][len(before["waits"][b]):] for b in ("postgres", "mongo")}
+    grown = after["rss"] - before["rss"] if after["rss"] is not None and before["rss"] is not None else None
+    return {
+        "sessions": args.sessions,
+        "elapsed_s": elapsed,
+        "runs": len(runs),
+        "throughput_runs_per_s": len(runs) / elapsed if elapsed else 0.0,
+        "errors": sum(r["errors"] > 0 for r in results),
+        "latency_ms": {a: percentiles([r["seconds"] for r in results if r["action"] == a])
+                       for a in ["load", "sidebar", *PANELS]},
+        "latency_ms_by_role": {role: percentiles([r["seconds"] for r in runs if r["role"] == role])
+                               for role in sorted({r["role"] for r in runs})},
+        "pool_wait_ms": {b: percentiles(w) for b, w in waits.items()},
+        "pool_timeouts": {b: after["timeouts"][b] - before["timeouts"][b] for b in waits},
+        "memory": {"rss_before": before["rss"], "rss_after": after["rss"], "rss_peak": after["rss_peak"],
+                   "rss_per_session": grown / args.sessions if grown is not None and args.sessions else None},
+    }
+
+
+def print_report(rep: dict):
+    def row(name, p):
+        if not p:
+            return f"  {name:<24} -"
+        return (f"  {name:<24} n={p['n']:<6} p50={p['p50']:8.1f}  p90={p['p90']:8.1f}  "
+                f"p99={p['p99']:8.1f}  max={p['max']:8.1f}")
+
+    print(f"{rep['sessions']} sessions, {rep['elapsed_s']:.1f}s: {rep['runs']:,} query runs, "
+          f"{rep['throughput_runs_per_s']:.2f} runs/s, {rep['errors']:,} reruns with errors")
+    print("latency (ms)")
+    for name, p in rep["latency_ms"].items():
+        print(row(name, p))
+    print("run latency by role (ms)")
+    for name, p in rep["latency_ms_by_role"].items():
+        print(row(name, p))
+    print("pool wait (ms)")
+    for name, p in rep["pool_wait_ms"].items():
+        print(row(name, p) + f"  timeouts={rep['pool_timeouts'][name]}")
+    mb = lambda b: f"{b / 1024 / 1024:,.1f} MB" if b is not None else "?"
+    m = rep["memory"]
+    print(f"worker memory: rss {mb(m['rss_before'])} -> {mb(m['rss_after'])} (peak {mb(m['rss_peak'])}), "
+          f"{mb(m['rss_per_session'])} per session")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Load-test the dashboard with concurrent simulated sessions.")
+    p.add_argument("--sessions", type=int, default=10)
+    p.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                   help="role weights, e.g. medical_worker=4,elderly=1 (default: %(default)s)")
+    p.add_argument("--duration", type=float, default=60.0, help="seconds to keep the sessions running")
+    p.add_argument("--iterations", type=int, default=0, help="query runs per session, 0 = until --duration")
+    p.add_argument("--think", type=float, default=1.0, help="mean think time between runs, seconds")
+    p.add_argument("--ramp", type=float, default=5.0, help="seconds over which the sessions start")
+    p.add_argument("--ids", type=int, default=20, help="elderly / worker / contact ids are drawn from 1..N")
+    p.add_argument("--timeout", type=float, default=120.0, help="per-rerun timeout, seconds")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--pg-uri", default=CONFIG["postgres"]["uri"])
+    p.add_argument("--mongo-uri", default=CONFIG["mongo"]["uri"])
+    p.add_argument("--mongo-db", default=CONFIG["mongo"]["db_name"])
+    p.add_argument("--port", type=int, default=8599, help="port for the app server the harness starts")
+    p.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    p.add_argument("--serve", metavar="STATS_FILE", help=argparse.SUPPRESS)  # the server process, see serve()
+    args = p.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    rng = random.Random(args.seed)
+    roles = rng.choices(list(args.mix), list(args.mix.values()), k=args.sessions)
+    with tempfile.TemporaryDirectory() as tmp, open(os.path.join(tmp, "server.log"), "w+") as log:
+        stats_path = os.path.join(tmp, "stats.json")
+        proc = start_server(args.port, stats_path, log)
+        try:
+            before = read_stats(stats_path)
+            results = []
+            started = time.time()
+            asyncio.run(run_sessions(roles, args, results, started + args.ramp + args.duration))
+            elapsed = time.time() - started
+            time.sleep(1.5)  # let the server write its stats once more
+            after = read_stats(stats_path)
+        finally:
+            stop_server(proc)
+    rep = build_report(results, before, after, elapsed, args)
+    print_report(rep)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(rep, fh, indent=2, default=float)
+
+
+if __name__ == "__main__":
+    main()
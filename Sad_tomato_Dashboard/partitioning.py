@@ -0,0 +1,200 @@
+import argparse
+import datetime as dt
+
+from sqlalchemy import text
+
+from queries import CONFIG, PG_SCHEMA
+from backend import make_mongo_client, make_pg_engine
+
+# Time-partitioned storage for the time-windowed panels (see apply_time_window
+# and window_stages in backend.py), so the default "last 7 days" view only
+# touches recent data:
+#
+#   python partitioning.py postgres [--months-back 12] [--months-ahead 3] [--dry-run]
+#                                   [--move-undated | --drop-uniqueness]
+#       Converts `alerts` into a table partitioned by month on alert_timestamp.
+#       Re-running it on an already partitioned table only adds the missing
+#       future months, so it can be scheduled (e.g. monthly from cron).
+#   python partitioning.py mongo [--dry-run]
+#       Moves `sensor_readings` into a time-series collection (timeField "ts",
+#       metaField "device_id") and indexes alert_readings on ts.
+#
+# Rows older than --months-back go into one alerts_archive partition, rows past
+# the last month into alerts_default.
+#
+# Uniqueness: a primary key on a partitioned table has to include the partition
+# key, so `alerts` gets PRIMARY KEY (alert_id, alert_timestamp), with
+# alert_timestamp NOT NULL. alert_vitals gets an alert_timestamp column, filled
+# from alerts, and its foreign key becomes (alert_id, alert_timestamp).
+# Alerts without a timestamp can't be in that table (260 of the 299 bundled
+# alerts have none), so by default the conversion refuses to run while any
+# exist. Either fix them first, or pick one of:
+#   --move-undated      move them into a plain `alerts_undated` table (same
+#                       columns, alert_id primary key). Panels that read
+#                       `alerts` no longer see them.
+#   --drop-uniqueness   keep every row in `alerts` (undated ones in
+#                       alerts_default) but drop alerts_pkey and the
+#                       alert_vitals foreign key; alert_id is then only indexed,
+#                       so duplicate alert_ids are accepted and LEFT JOINs on
+#                       alert_id can fan out.
+
+
+def month_start(d: dt.date) -> dt.date:
+    return d.replace(day=1)
+
+
+def add_months(d: dt.date, n: int) -> dt.date:
+    y, m = divmod(d.month - 1 + n, 12)
+    return d.replace(year=d.year + y, month=m + 1, day=1)
+
+
+def month_partitions(first: dt.date, last: dt.date) -> list[str]:
+    stmts, m = [], month_start(first)
+    while m <= last:
+        nxt = add_months(m, 1)
+        stmts.append(
+            f"CREATE TABLE IF NOT EXISTS {PG_SCHEMA}.alerts_y{m:%Y}m{m:%m} PARTITION OF {PG_SCHEMA}.alerts "
+            f"FOR VALUES FROM ('{m:%Y-%m-%d}') TO ('{nxt:%Y-%m-%d}')"
+        )
+        m = nxt
+    return stmts
+
+
+def pg_partition_statements(conn, months_back: int, months_ahead: int, undated: str = "refuse") -> list[str]:
+    today = dt.date.today()
+    first, last = add_months(today, -months_back), add_months(today, months_ahead)
+    partitioned = conn.execute(text(
+        "SELECT c.relkind = 'p' FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = :schema AND c.relname = 'alerts'"
+    ), {"schema": PG_SCHEMA}).scalar()
+    if partitioned:
+        return month_partitions(today, last)
+
+    s = PG_SCHEMA
+    n_undated = conn.execute(text(f"SELECT count(*) FROM {s}.alerts WHERE alert_timestamp IS NULL")).scalar()
+    if n_undated and undated == "refuse":
+        raise SystemExit(
+            f"{n_undated:,} alerts have no alert_timestamp, so alerts can't get its (alert_id, alert_timestamp) "
+            f"primary key. Fix them, or re-run with --move-undated or --drop-uniqueness (see --help)."
+        )
+    keep_unique = undated != "drop"
+    stmts = [
+        # The old foreign key points at alerts(alert_id), which stops being unique on its own.
+        f"ALTER TABLE {s}.alert_vitals DROP CONSTRAINT IF EXISTS alert_vitals_alert_id_fkey",
+        f"ALTER TABLE {s}.alerts RENAME TO alerts_unpartitioned",
+        f"ALTER TABLE {s}.alerts_unpartitioned RENAME CONSTRAINT alerts_pkey TO alerts_unpartitioned_pkey",
+        f"CREATE TABLE {s}.alerts (LIKE {s}.alerts_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        f"PARTITION BY RANGE (alert_timestamp)",
+        f"ALTER TABLE {s}.alerts ADD FOREIGN KEY (elderly_id) REFERENCES {s}.elderly (elderly_id)",
+        f"ALTER TABLE {s}.alerts ADD FOREIGN KEY (device_id) REFERENCES {s}.devices (device_id)",
+        f"CREATE TABLE {s}.alerts_archive PARTITION OF {s}.alerts FOR VALUES FROM (MINVALUE) TO ('{first:%Y-%m-%d}')",
+        f"CREATE TABLE {s}.alerts_default PARTITION OF {s}.alerts DEFAULT",
+        *month_partitions(first, last),
+        f"CREATE INDEX ON {s}.alerts (elderly_id, alert_timestamp DESC)",
+        f"CREATE INDEX ON {s}.alerts (device_id)",
+    ]
+    if keep_unique:
+        stmts += [
+            f"ALTER TABLE {s}.alerts ALTER COLUMN alert_timestamp SET NOT NULL",
+            f"ALTER TABLE {s}.alerts ADD CONSTRAINT alerts_pkey PRIMARY KEY (alert_id, alert_timestamp)",
+        ]
+        if n_undated:
+            stmts += [
+                f"CREATE TABLE {s}.alerts_undated (LIKE {s}.alerts_unpartitioned INCLUDING DEFAULTS "
+                f"INCLUDING CONSTRAINTS, PRIMARY KEY (alert_id))",
+                f"INSERT INTO {s}.alerts_undated SELECT * FROM {s}.alerts_unpartitioned WHERE alert_timestamp IS NULL",
+            ]
+        stmts += [
+            f"INSERT INTO {s}.alerts SELECT * FROM {s}.alerts_unpartitioned WHERE alert_timestamp IS NOT NULL",
+            f"ALTER TABLE {s}.alert_vitals ADD COLUMN IF NOT EXISTS alert_timestamp timestamp without time zone",
+            f"UPDATE {s}.alert_vitals v SET alert_timestamp = a.alert_timestamp FROM {s}.alerts a "
+            f"WHERE a.alert_id = v.alert_id",
+            # Vitals of undated alerts keep a NULL alert_timestamp, which the
+            # (default MATCH SIMPLE) foreign key doesn't check.
+            f"ALTER TABLE {s}.alert_vitals ADD CONSTRAINT alert_vitals_alert_fkey FOREIGN KEY "
+            f"(alert_id, alert_timestamp) REFERENCES {s}.alerts (alert_id, alert_timestamp)",
+        ]
+    else:
+        stmts += [
+            # --drop-uniqueness: alert_id is only indexed from here on.
+            f"CREATE INDEX ON {s}.alerts (alert_id)",
+            f"INSERT INTO {s}.alerts SELECT * FROM {s}.alerts_unpartitioned",
+        ]
+    return stmts + [
+        f"DROP TABLE {s}.alerts_unpartitioned",
+        f"ANALYZE {s}.alerts",
+    ]
+
+
+def partition_postgres(uri: str, months_back: int, months_ahead: int, dry_run: bool, undated: str = "refuse"):
+    eng = make_pg_engine(uri)
+    # One transaction: a failure half-way leaves the original alerts table alone.
+    with eng.connect() as conn:
+        for stmt in pg_partition_statements(conn, months_back, months_ahead, undated):
+            print(stmt + ";")
+            if not dry_run:
+                conn.execute(text(stmt))
+        if not dry_run:
+            conn.commit()
+
+
+def partition_mongo(uri: str, db_name: str, dry_run: bool, batch_size: int = 5000):
+    db = make_mongo_client(uri)[db_name]
+    opts = db.command("listCollections", filter={"name": "sensor_readings"})["cursor"]["firstBatch"]
+    if opts and opts[0].get("type") == "timeseries":
+        print("sensor_readings is already a time-series collection")
+    else:
+        print("sensor_readings -> sensor_readings_raw, new time-series sensor_readings (ts / device_id)")
+        if not dry_run:
+            # Time-series collections can't be the target of renameCollection,
+            # so the raw data moves aside and is copied in.
+            if opts:
+                db["sensor_readings"].rename("sensor_readings_raw")
+            db.create_collection("sensor_readings", timeseries={
+                "timeField": "ts", "metaField": "device_id", "granularity": "minutes",
+            })
+            batch = []
+            for doc in db["sensor_readings_raw"].find({"ts": {"$type": "date"}}, {"_id": 0}):
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    db["sensor_readings"].insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                db["sensor_readings"].insert_many(batch, ordered=False)
+            db["sensor_readings"].create_index([("elderly_id", 1), ("ts", -1)])
+            print(f"copied {db['sensor_readings'].count_documents({}):,} readings; "
+                  f"sensor_readings_raw can be dropped once checked")
+
+    print("alert_readings: index on ts")
+    if not dry_run:
+        db["alert_readings"].create_index([("ts", -1)])
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Set up time-partitioned storage for alerts and sensor readings.")
+    sub = p.add_subparsers(dest="backend", required=True)
+    pg = sub.add_parser("postgres")
+    pg.add_argument("--uri", default=CONFIG["postgres"]["uri"])
+    pg.add_argument("--months-back", type=int, default=12)
+    pg.add_argument("--months-ahead", type=int, default=3)
+    pg.add_argument("--dry-run", action="store_true", help="print the statements without applying them")
+    nulls = pg.add_mutually_exclusive_group()
+    nulls.add_argument("--move-undated", dest="undated", action="store_const", const="move", default="refuse",
+                       help="move alerts without alert_timestamp into alerts_undated")
+    nulls.add_argument("--drop-uniqueness", dest="undated", action="store_const", const="drop",
+                       help="keep undated alerts in alerts_default; drops alerts_pkey and the alert_vitals "
+                            "foreign key, so duplicate alert_ids are accepted")
+    mg = sub.add_parser("mongo")
+    mg.add_argument("--uri", default=CONFIG["mongo"]["uri"])
+    mg.add_argument("--db", default=CONFIG["mongo"]["db_name"])
+    mg.add_argument("--dry-run", action="store_true")
+    args = p.parse_args(argv)
+
+    if args.backend == "postgres":
+        partition_postgres(args.uri, args.months_back, args.months_ahead, args.dry_run, args.undated)
+    else:
+        partition_mongo(args.uri, args.db, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+from sqlalchemy import text
+
+from queries import CONFIG, qualify
+from backend import make_mongo_client, make_pg_engine, mongo_pipeline, params_context, pg_statement
+
+# Query-plan regression check for the saved queries in CONFIG, against a
+# reference copy of the data (e.g. the bundled dumps restored locally):
+#
+#   python plans.py capture [--estimate]       # write the golden plans
+#   python plans.py check [--max-growth 0.5]   # compare, exit 1 on a regression
+#   python plans.py lint                       # cheap static checks of the saved SQL
+#
+# For every Postgres query (and federated dimension) the plan comes from
+# EXPLAIN (ANALYZE, FORMAT JSON) -- or plain EXPLAIN with --estimate -- and for
+# every Mongo aggregation from explain with executionStats. The golden file
+# keeps, per query, the estimated cost, the rows / documents examined, the
+# tables or collections read by a full scan (Seq Scan / COLLSCAN) and the plan
+# nodes. `check` fails when a query gains a full scan or its examined rows grow
+# by more than --max-growth (and by at least --min-rows, so tiny tables don't
+# trip it); other differences are printed for review.
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plans_golden.json")
+PG_SCAN_EXTRA = ("Rows Removed by Filter", "Rows Removed by Index Recheck")
+
+
+def walk(obj):
+    # Every dict nested anywhere in an explain document.
+    if isinstance(obj, dict):
+        yield obj
+        for v in obj.values():
+            yield from walk(v)
+    elif isinstance(obj, list):
+        for v in obj:
+            yield from walk(v)
+
+
+# What a saved query's statement is built from. The bound statement itself
+# can't be fingerprinted: window_stages puts a wall-clock cutoff into it.
+SOURCE_KEYS = ("sql", "collection", "aggregate", "time_column", "time_field", "time_granularity", "chart", "joins")
+
+
+def fingerprint(source) -> str:
+    if isinstance(source, dict):
+        source = {k: source[k] for k in SOURCE_KEYS if k in source}
+    return hashlib.sha1(json.dumps(source, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def pg_plan(conn, sql: str, params: dict, analyze: bool) -> dict:
+    options = "ANALYZE, FORMAT JSON" if analyze else "FORMAT JSON"
+    doc = conn.execute(text(f"EXPLAIN ({options}) {sql}"), params).scalar()
+    if isinstance(doc, str):
+        doc = json.loads(doc)
+    root = doc[0]["Plan"]
+    nodes, full_scans, examined = [], set(), 0
+    for node in walk(root):
+        if "Node Type" not in node:
+            continue
+        rel = node.get("Relation Name")
+        nodes.append(node["Node Type"] + (f" on {rel}" if rel else ""))
+        if node["Node Type"] == "Seq Scan":
+            full_scans.add(rel)
+        if rel:
+            # Rows a scan read: what it returned plus what its filters threw
+            # away, per loop. Without ANALYZE only the returned-row estimate exists.
+            if analyze:
+                per_loop = node.get("Actual Rows", 0) + sum(node.get(k, 0) for k in PG_SCAN_EXTRA)
+                examined += per_loop * node.get("Actual Loops", 1)
+            else:
+                examined += node.get("Plan Rows", 0)
+    return {"cost": root.get("Total Cost"), "rows_examined": int(examined),
+            "full_scans": sorted(full_scans), "nodes": nodes}
+
+
+def mongo_plan(db, coll: str, stages: list) -> dict:
+    doc = db.command("explain", {"aggregate": coll, "pipeline": stages, "cursor": {}},
+                     verbosity="executionStats")
+    nodes, full_scans = [], set()
+    for plan in (d["winningPlan"] for d in walk(doc) if "winningPlan" in d):
+        for node in walk(plan):
+            if "stage" in node:
+                nodes.append(node["stage"] + (f" on {node['indexName']}" if "indexName" in node else ""))
+                if node["stage"] == "COLLSCAN":
+                    full_scans.add(coll)
+    stats = [d for d in walk(doc) if "totalDocsExamined" in d]
+    return {"cost": None,  # the Mongo planner has no cost model to report
+            "rows_examined": sum(d["totalDocsExamined"] for d in stats),
+            "keys_examined": sum(d.get("totalKeysExamined", 0) for d in stats),
+            "full_scans": sorted(full_scans), "nodes": nodes}
+
+
+def saved_statements(ctx: dict):
+    # (key, backend, statement, source) for every saved query: the statement
+    # bound like the dashboard binds it, and the CONFIG entry it came from.
+    for name, q in CONFIG["postgres"]["queries"].items():
+        yield f"postgres:{name}", "postgres", pg_statement(q, ctx, chart=True), q
+    for name, sql in CONFIG["federated"]["dimensions"].items():
+        yield f"dimension:{name}", "postgres", (qualify(sql), {}), sql
+    for section in ("mongo", "federated"):
+        for name, q in CONFIG[section]["queries"].items():
+            yield f"{section}:{name}", "mongo", (q["collection"], mongo_pipeline(q, ctx, chart=True)), q
+
+
+def capture(args) -> dict:
+    ctx = params_context(dict(p.split("=", 1) for p in args.param))
+    engine = make_pg_engine(args.pg_uri) if CONFIG["postgres"]["enabled"] else None
+    db = make_mongo_client(args.mongo_uri)[args.mongo_db] if CONFIG["mongo"]["enabled"] else None
+    plans = {}
+    conn = engine.connect() if engine is not None else None
+    try:
+        for key, backend, statement, source in saved_statements(ctx):
+            if args.only and args.only.lower() not in key.lower():
+                continue
+            if (conn if backend == "postgres" else db) is None:
+                continue
+            try:
+                if backend == "postgres":
+                    plan = pg_plan(conn, *statement, analyze=not args.estimate)
+                else:
+                    plan = mongo_plan(db, *statement)
+            except Exception as e:
+                if backend == "postgres":
+                    conn.rollback()  # the failed statement aborted the transaction
+                plan = {"error": str(e).splitlines()[0]}
+            plans[key] = {"backend": backend, "fingerprint": fingerprint(source), **plan}
+    finally:
+        if conn is not None:
+            conn.rollback()  # EXPLAIN ANALYZE runs the queries; never keep anything
+            conn.close()
+    return plans
+
+
+def compare(golden: dict, current: dict, max_growth: float, min_rows: int) -> tuple[list[str], list[str]]:
+    failures, notes = [], []
+    for key, now in current.items():
+        before = golden.get(key)
+        if before is None:
+            notes.append(f"new      {key}: no golden plan yet")
+            continue
+        if "error" in now:
+            if "error" not in before:
+                failures.append(f"FAIL     {key}: {now['error']}")
+            continue
+        if "error" in before:
+            notes.append(f"fixed    {key}: previously failed with {before['error']}")
+            continue
+        for source in sorted(set(now["full_scans"]) - set(before["full_scans"])):
+            scan = "Seq Scan" if now["backend"] == "postgres" else "COLLSCAN"
+            failures.append(f"FAIL     {key}: new {scan} on {source}")
+        b, n = before["rows_examined"], now["rows_examined"]
+        if n - b >= min_rows and n > b * (1 + max_growth):
+            failures.append(f"FAIL     {key}: rows examined {b:,} -> {n:,}")
+        if before.get("cost") and now.get("cost") and now["cost"] > before["cost"] * (1 + max_growth):
+            notes.append(f"cost     {key}: {before['cost']:,.1f} -> {now['cost']:,.1f}")
+        if now["nodes"] != before["nodes"]:
+            notes.append(f"changed  {key}: {' > '.join(before['nodes'])}\n"
+                         f"         {' ' * len(key)}  now {' > '.join(now['nodes'])}")
+        elif now["fingerprint"] != before["fingerprint"]:
+            notes.append(f"edited   {key}: statement changed, same plan")
+    for key in sorted(set(golden) - set(current)):
+        notes.append(f"removed  {key}: in the golden file only")
+    return failures, notes
+
+
+def lint() -> list[str]:
+    # Mistakes the planner doesn't complain about but that hide real edits:
+    # repeated predicates, and table names whose case differs from the schema
+    # (unquoted names fold to lower case, so they work -- until someone quotes them).
+    out = []
+    sources = {f"postgres:{n}": q["sql"] for n, q in CONFIG["postgres"]["queries"].items()}
+    sources.update({f"dimension:{n}": sql for n, sql in CONFIG["federated"]["dimensions"].items()})
+    for key, sql in sources.items():
+        seen = set()
+        for line in sql.splitlines():
+            cond = re.sub(r"\s+", " ", line.strip().rstrip(";")).lower()
+            if not re.match(r"(and|or) ", cond):
+                continue
+            if cond in seen:
+                out.append(f"{key}: repeated predicate `{line.strip()}`")
+            seen.add(cond)
+        for table in re.findall(r"\b(?:FROM|JOIN)\s+([A-Za-z_][\w.]*)", sql, flags=re.IGNORECASE):
+            if table != table.lower() and not table.startswith("{S}."):
+                out.append(f"{key}: table `{table}` is not lower case")
+    return out
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Capture and check query plans of the saved queries.")
+    p.add_argument("--golden", default=GOLDEN, help="golden plans file (default: %(default)s)")
+    p.add_argument("--pg-uri", default=CONFIG["postgres"]["uri"])
+    p.add_argument("--mongo-uri", default=CONFIG["mongo"]["uri"])
+    p.add_argument("--mongo-db", default=CONFIG["mongo"]["db_name"])
+    sub = p.add_subparsers(dest="cmd", required=True)
+    for cmd, text_ in (("capture", "record the golden plans"), ("check", "compare against the golden plans")):
+        c = sub.add_parser(cmd, help=text_)
+        c.add_argument("--param", action="append", default=[], metavar="NAME=VALUE",
+                       help="override a PARAMS_CTX default, e.g. --param elderly_id=3")
+        c.add_argument("--only", metavar="TEXT", help="only queries whose key contains TEXT")
+        c.add_argument("--estimate", action="store_true", help="plain EXPLAIN: planner estimates, no execution")
+        if cmd == "check":
+            c.add_argument("--max-growth", type=float, default=0.5,
+                           help="fail when rows examined grow by more than this fraction (default: %(default)s)")
+            c.add_argument("--min-rows", type=int, default=1000,
+                           help="...and by at least this many rows (default: %(default)s)")
+    sub.add_parser("lint", help="static checks of the saved SQL")
+    args = p.parse_args(argv)
+
+    if args.cmd == "lint":
+        problems = lint()
+        print("\n".join(problems) or "no problems found")
+        return
+    current = capture(args)
+    if args.cmd == "capture":
+        golden = {}
+        if args.only and os.path.exists(args.golden):
+            with open(args.golden, encoding="utf-8") as fh:
+                golden = json.load(fh)
+        golden.update(current)
+        with open(args.golden, "w", encoding="utf-8") as fh:
+            json.dump(golden, fh, indent=2, ensure_ascii=False, sort_keys=True)
+        errors = sum("error" in v for v in current.values())
+        print(f"captured {len(current)} plans into {args.golden}" + (f", {errors} failed" if errors else ""))
+        return
+
+    with open(args.golden, encoding="utf-8") as fh:
+        golden = json.load(fh)
+    if args.only:
+        golden = {k: v for k, v in golden.items() if args.only.lower() in k.lower()}
+    failures, notes = compare(golden, current, args.max_growth, args.min_rows)
+    for line in notes + failures:
+        print(line)
+    print(f"{len(current)} plans checked, {len(failures)} regressions")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
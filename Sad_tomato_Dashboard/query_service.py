@@ -0,0 +1,328 @@
+import argparse
+import csv
+import io
+import json
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from queries import CONFIG
+from backend import (
+    DimensionCache, LastResults, bind_params, federated_join, fetch_mongo, fetch_pg,
+    fetch_with_fallback, filter_queries_by_role, frame_memory, make_mongo_client, make_pg_engine, mongo_options,
+    mongo_pipeline, params_context, pg_statement,
+)
+
+# Headless access to the saved queries in CONFIG, for report jobs and paging
+# scripts that should not pay for a Streamlit rerun per result.
+#
+#   python query_service.py list --role medical_worker
+#   python query_service.py run "recent alert history" --param elderly_id=3 --format jsonl
+#   python query_service.py run "recent alert history" --batch elderly.jsonl --format csv > report.csv
+#   python query_service.py serve --port 8765
+#       GET /queries?role=elderly
+#       GET /cache                        (rows and memory per cached result)
+#       GET /run?q=recent+alert+history&elderly_id=3&format=csv
+#
+# --batch takes one JSON object of parameters per line and runs the query once
+# per line; the bound parameters are prepended as columns so the rows of every
+# run can be told apart in one output stream.
+
+CACHE_TTL = 60  # seconds, same as run_mongo_aggregate in app.py
+FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+_cache = {}
+_cache_lock = threading.Lock()
+_dimensions = DimensionCache()
+_last_results = LastResults()
+BACKENDS = ("postgres", "mongo", "federated")
+
+
+# One engine / client per URI for the life of the process, like st.cache_resource.
+@lru_cache(maxsize=None)
+def get_pg_engine(uri: str):
+    return make_pg_engine(uri)
+
+
+@lru_cache(maxsize=None)
+def get_mongo_client(uri: str):
+    return make_mongo_client(uri)
+
+
+def cached(key: tuple, fn):
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and now - hit[0] < CACHE_TTL:
+            return hit[1]
+    df = fn()
+    with _cache_lock:
+        for k in [k for k, (t, _) in _cache.items() if now - t >= CACHE_TTL]:
+            del _cache[k]
+        _cache[key] = (now, df)
+    return df
+
+
+def cache_stats() -> list[dict]:
+    now = time.monotonic()
+    with _cache_lock:
+        items = list(_cache.items())
+    return [{"backend": k[0], "query": k[1], "params": dict(k[2]), "rows": len(df),
+             "bytes": frame_memory(df), "age_s": round(now - t, 1)} for k, (t, df) in items]
+
+
+def list_queries(role: str = "all") -> list[dict]:
+    # filter_queries_by_role only lets through queries tagged "all" (none are),
+    # so "all" here means no filtering at all.
+    out = []
+    for backend in BACKENDS:
+        qdict = CONFIG[backend]["queries"]
+        if role.lower() != "all":
+            qdict = filter_queries_by_role(qdict, role)
+        for name, q in qdict.items():
+            out.append({"backend": backend, "name": name, "params": q.get("params", []),
+                        "tags": q.get("tags", [])})
+    return out
+
+
+def find_query(name: str, backend: str | None = None) -> tuple[str, str, dict]:
+    # Exact name first, then a unique case-insensitive substring, so callers do
+    # not have to spell out the full sentence-long query titles.
+    backends = [backend] if backend else list(BACKENDS)
+    candidates = [(b, n, q) for b in backends for n, q in CONFIG[b]["queries"].items()]
+    exact = [c for c in candidates if c[1] == name]
+    if exact:
+        return exact[0]
+    hits = [c for c in candidates if name.lower() in c[1].lower()]
+    if len(hits) == 1:
+        return hits[0]
+    if not hits:
+        raise KeyError(f"no saved query matches {name!r}")
+    raise KeyError(f"{name!r} is ambiguous: " + "; ".join(n for _, n, _ in hits))
+
+
+def run_query(backend: str, name: str, q: dict, ctx: dict, conn: dict) -> pd.DataFrame:
+    params = bind_params(q, ctx)
+    key = (backend, name, tuple(sorted(params.items())), tuple(sorted(conn.items())))
+    if backend == "postgres":
+        eng = get_pg_engine(conn["pg_uri"])
+        sql, stmt_params = pg_statement(q, ctx)
+        return cached(key, lambda: fetch_pg(eng, sql, stmt_params))
+    client = get_mongo_client(conn["mongo_uri"])
+    stages = mongo_pipeline(q, ctx)
+
+    def aggregate():
+        # Over its time budget, a Mongo query answers with its last result.
+        df, stale = fetch_with_fallback(_last_results, key, lambda: fetch_mongo(
+            client, conn["mongo_db"], q["collection"], stages, q.get("sketch"), **mongo_options(q),
+            comment=f"query_service:{name}"))
+        if stale is not None:
+            print(f"query_service: {name!r} ran over its time budget, serving the result from {stale:.0f}s ago",
+                  file=sys.stderr)
+        return df
+
+    if backend == "federated":
+        eng = get_pg_engine(conn["pg_uri"])
+        return cached(key, lambda: federated_join(aggregate(), q, ctx, lambda name: _dimensions.get(eng, name)))
+    return cached(key, aggregate)
+
+
+def iter_results(backend: str, name: str, q: dict, param_sets: list[dict], conn: dict, tag: bool):
+    for overrides in param_sets:
+        ctx = params_context(overrides)
+        df = run_query(backend, name, q, ctx, conn)
+        if tag:
+            df = df.copy()
+            for i, (k, v) in enumerate(bind_params(q, ctx).items()):
+                df.insert(i, k, v)
+        yield df
+
+
+def widen(df: pd.DataFrame) -> pd.DataFrame:
+    # compact_frame picks dtypes per result (int8 for one elderly, int16 for
+    # the next; categoricals with different categories), so Arrow batches use
+    # the wide types every result of the query converts to losslessly.
+    out = {}
+    for c in df.columns:
+        s = df[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype(s.cat.categories.dtype)
+        elif pd.api.types.is_integer_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+            s = s.astype("int64")
+        elif pd.api.types.is_float_dtype(s.dtype):
+            s = s.astype("float64")
+        out[c] = s
+    return pd.DataFrame(out, index=df.index)
+
+
+def write_stream(frames, fmt: str, out):
+    # Writes each result as soon as it is fetched; `out` is a binary stream.
+    if fmt == "csv":
+        # The header comes from the first result with rows: an empty Mongo result
+        # has only the inserted parameter columns. Later results are aligned to
+        # it, since documents of different runs may not share every field.
+        columns, widest = None, []
+        for df in frames:
+            if df.empty:
+                if len(df.columns) > len(widest):
+                    widest = list(df.columns)
+                continue
+            if columns is None:
+                columns = list(df.columns)
+                header = True
+            else:
+                extra = [c for c in df.columns if c not in columns]
+                if extra:
+                    print(f"query_service: dropping columns missing from the csv header: {', '.join(map(str, extra))}",
+                          file=sys.stderr)
+                df = df.reindex(columns=columns)
+                header = False
+            buf = io.StringIO()
+            df.to_csv(buf, index=False, header=header, quoting=csv.QUOTE_MINIMAL)
+            out.write(buf.getvalue().encode("utf-8"))
+            out.flush()
+        if columns is None and widest:
+            out.write((",".join(map(str, widest)) + "\n").encode("utf-8"))
+    elif fmt == "jsonl":
+        for df in frames:
+            if not df.empty:
+                out.write(df.to_json(orient="records", lines=True, date_format="iso",
+                                     force_ascii=False).rstrip("\n").encode("utf-8") + b"\n")
+                out.flush()
+    elif fmt == "arrow":
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise SystemExit("--format arrow needs pyarrow (pip install pyarrow)")
+        writer = schema = None
+        for df in frames:
+            if df.empty:
+                continue
+            # Every batch has to match the schema of the first non-empty result.
+            table = pa.Table.from_pandas(widen(df), schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_stream(out, schema)
+            writer.write_table(table)
+            out.flush()
+        if writer is not None:
+            writer.close()
+    else:
+        raise ValueError(f"unknown format {fmt!r}")
+
+
+def parse_param_args(items: list[str]) -> dict:
+    params = {}
+    for item in items or []:
+        k, sep, v = item.partition("=")
+        if not sep:
+            raise SystemExit(f"--param expects KEY=VALUE, got {item!r}")
+        params[k] = v
+    return params
+
+
+def read_batch(path: str) -> list[dict]:
+    fh = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    conn = {}
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/queries":
+            return self.send_json(200, list_queries(args.get("role", "all")))
+        if url.path == "/cache":
+            return self.send_json(200, cache_stats())
+        if url.path != "/run":
+            return self.send_json(404, {"error": f"unknown path {url.path}"})
+
+        fmt = args.pop("format", "jsonl")
+        backend = args.pop("backend", None)
+        if fmt not in FORMATS:
+            return self.send_json(400, {"error": f"format must be one of {sorted(FORMATS)}"})
+        try:
+            backend, name, q = find_query(args.pop("q", ""), backend)
+            df = run_query(backend, name, q, params_context(args), self.conn)
+        except KeyError as e:
+            return self.send_json(404, {"error": str(e.args[0])})
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": f"{backend} error: {e}"})
+
+        # No Content-Length: the body is streamed and ends when the connection closes.
+        self.send_response(200)
+        self.send_header("Content-Type", FORMATS[fmt])
+        self.end_headers()
+        write_stream([df], fmt, self.wfile)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Run the dashboard's saved queries without Streamlit.")
+    p.add_argument("--pg-uri", default=CONFIG["postgres"]["uri"])
+    p.add_argument("--mongo-uri", default=CONFIG["mongo"]["uri"])
+    p.add_argument("--mongo-db", default=CONFIG["mongo"]["db_name"])
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    ls = sub.add_parser("list", help="list saved queries")
+    ls.add_argument("--role", default="all")
+
+    run = sub.add_parser("run", help="run one saved query and stream the rows to stdout")
+    run.add_argument("query", help="exact name or a unique substring of it")
+    run.add_argument("--backend", choices=BACKENDS)
+    run.add_argument("--param", action="append", metavar="KEY=VALUE")
+    run.add_argument("--batch", metavar="FILE", help="JSON lines of parameter sets ('-' for stdin)")
+    run.add_argument("--format", choices=sorted(FORMATS), default="csv")
+
+    srv = sub.add_parser("serve", help="serve the saved queries over a local HTTP API")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8765)
+
+    args = p.parse_args(argv)
+    conn = {"pg_uri": args.pg_uri, "mongo_uri": args.mongo_uri, "mongo_db": args.mongo_db}
+
+    if args.cmd == "list":
+        for item in list_queries(args.role):
+            print(f"{item['backend']:<8} {','.join(item['params']) or '-':<22} {item['name']}")
+    elif args.cmd == "run":
+        try:
+            backend, name, q = find_query(args.query, args.backend)
+        except KeyError as e:
+            raise SystemExit(e.args[0])
+        base = parse_param_args(args.param)
+        param_sets = [{**base, **row} for row in read_batch(args.batch)] if args.batch else [base]
+        frames = iter_results(backend, name, q, param_sets, conn, tag=bool(args.batch))
+        write_stream(frames, args.format, sys.stdout.buffer)
+    elif args.cmd == "serve":
+        QueryHandler.conn = conn
+        server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+        print(f"Serving saved queries on http://{args.host}:{args.port}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
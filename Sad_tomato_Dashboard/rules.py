@@ -0,0 +1,353 @@
+import argparse
+import datetime as dt
+import json
+import operator
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from queries import CONFIG
+from backend import make_mongo_client
+
+# Threshold rules over sensor_readings, evaluated per elderly over sliding time
+# windows instead of relying on the precomputed `is_abnormal` flag.
+#
+#   python rules.py show [--rules my_rules.json]
+#   python rules.py backfill --days 30 [--chunk-days 1] [--to-collection rule_alerts]
+#   python rules.py stream [--poll 5] [--max-batch 5000] [--late-window 300]   # new readings as they arrive
+#   python rules.py stream --stdin < readings.jsonl
+#
+# Two rule types:
+#   sustained  `field op threshold` holds on every reading for at least
+#              `duration` seconds (readings further than `max_gap` apart break
+#              the run); fires once per run, on the reading that reaches it.
+#   drop       `field` falls by at least `delta` from its maximum over the
+#              previous `window` seconds; fires on the first reading of a drop.
+# "overrides" replaces rule settings for individual elderly ids.
+#
+# Readings are sorted by (elderly_id, ts) into flat NumPy arrays and every
+# rule is evaluated for all elderly at once; no Python loop runs per reading.
+
+DEFAULT_RULES = [
+    {"name": "sustained_tachycardia", "type": "sustained", "field": "heart_rate", "op": ">", "threshold": 120,
+     "duration": 300},
+    {"name": "sustained_bradycardia", "type": "sustained", "field": "heart_rate", "op": "<", "threshold": 50,
+     "duration": 300},
+    {"name": "low_spo2", "type": "sustained", "field": "oxygen_level", "op": "<", "threshold": 90, "duration": 120},
+    {"name": "spo2_drop", "type": "drop", "field": "oxygen_level", "delta": 4, "window": 600},
+    {"name": "fever", "type": "sustained", "field": "body_temperature", "op": ">", "threshold": 38.0,
+     "duration": 900},
+]
+DEFAULT_MAX_GAP = 900  # seconds
+OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+EVENT_COLUMNS = ["rule", "elderly_id", "device_id", "ts", "field", "value", "limit", "since"]
+
+
+def lookback(rules: list[dict]) -> float:
+    # How much history a batch needs so that every rule sees its whole window.
+    return max([r.get("duration", 0) + r.get("max_gap", DEFAULT_MAX_GAP) if r["type"] == "sustained"
+                else r.get("window", 0) for r in rules] + [0])
+
+
+def readings_frame(docs: list[dict]) -> pd.DataFrame:
+    # sensor_readings documents -> one row per reading, vital_signs flattened,
+    # "120/80" blood pressure split into systolic / diastolic.
+    df = pd.json_normalize(docs)
+    if df.empty:
+        return df
+    df.columns = [c.removeprefix("vital_signs.") for c in df.columns]
+    if "blood_pressure" in df.columns:
+        bp = df["blood_pressure"].astype(str).str.extract(r"(\d+)\s*/\s*(\d+)").astype(float)
+        df["blood_pressure_systolic"], df["blood_pressure_diastolic"] = bp[0], bp[1]
+    df["ts"] = pd.to_datetime(df["ts"], utc=True)
+    return df
+
+
+def per_row(rule: dict, key: str, elderly: np.ndarray) -> np.ndarray:
+    values = np.full(len(elderly), rule[key], dtype=float)
+    for eid, o in rule.get("overrides", {}).items():
+        if key in o:
+            values[elderly == eid] = o[key]
+    return values
+
+
+def range_max(v: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    # max(v[lo[i]..hi[i]]) for every i, from a sparse table (O(n log n) build,
+    # O(1) per query, all vectorized).
+    levels, k = [v], 1
+    while (1 << k) <= len(v):
+        prev, half = levels[-1], 1 << (k - 1)
+        levels.append(np.maximum(prev[:-half], prev[half:]))
+        k += 1
+    j = np.floor(np.log2(hi - lo + 1)).astype(int)
+    out = np.empty(len(v))
+    for level in np.unique(j):
+        sel = j == level
+        out[sel] = np.maximum(levels[level][lo[sel]], levels[level][hi[sel] - (1 << level) + 1])
+    return out
+
+
+def evaluate(df: pd.DataFrame, rules: list[dict]) -> tuple[pd.DataFrame, dict]:
+    # Returns the events and, per elderly id, the start of any sustained run
+    # still open at the last reading (streaming mode keeps those readings).
+    if df.empty:
+        return pd.DataFrame(columns=EVENT_COLUMNS), {}
+    df = df.sort_values(["elderly_id", "ts"], kind="stable").reset_index(drop=True)
+    n = len(df)
+    elderly = df["elderly_id"].astype(str).to_numpy()
+    t = ((df["ts"] - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)).to_numpy(float)
+    new_group = np.r_[True, elderly[1:] != elderly[:-1]]
+    last_in_group = np.r_[new_group[1:], True]
+    rows = np.arange(n)
+    g = np.cumsum(new_group) - 1
+    span = t.max() - t.min() + lookback(rules) + 1
+    key = g * span + (t - t.min())  # sorted; lets one searchsorted respect group bounds
+
+    events, open_runs = [], {}
+    for rule in rules:
+        if rule["field"] not in df.columns:
+            continue
+        v = pd.to_numeric(df[rule["field"]], errors="coerce").to_numpy(float)
+        valid = ~np.isnan(v)
+        if rule["type"] == "sustained":
+            limit = per_row(rule, "threshold", elderly)
+            duration = per_row(rule, "duration", elderly)
+            max_gap = rule.get("max_gap", DEFAULT_MAX_GAP)
+            m = valid & OPS[rule["op"]](np.where(valid, v, 0.0), limit)
+            gap = np.r_[np.inf, np.diff(t)] > max_gap
+            starts = m & (new_group | ~np.r_[False, m[:-1]] | gap)
+            start_idx = np.maximum.accumulate(np.where(starts, rows, 0))
+            hit = m & (t - t[start_idx] >= duration)
+            fire = hit & (starts | ~np.r_[False, hit[:-1]])
+            since = t[start_idx]
+            for i in np.flatnonzero(m & last_in_group):
+                open_runs[elderly[i]] = min(open_runs.get(elderly[i], np.inf), since[i])
+        elif rule["type"] == "drop":
+            limit = per_row(rule, "delta", elderly)
+            window = rule["window"]
+            lo = np.searchsorted(key, key - window, side="left")
+            peak = range_max(np.where(valid, v, -np.inf), lo, rows)
+            hit = valid & (peak - v >= limit)
+            fire = hit & (new_group | ~np.r_[False, hit[:-1]])
+            since = np.full(n, np.nan)
+        else:
+            raise ValueError(f"unknown rule type {rule['type']!r}")
+
+        idx = np.flatnonzero(fire)
+        if len(idx):
+            events.append(pd.DataFrame({
+                "rule": rule["name"], "elderly_id": elderly[idx],
+                "device_id": df["device_id"].to_numpy()[idx] if "device_id" in df.columns else None,
+                "ts": df["ts"].to_numpy()[idx], "field": rule["field"], "value": v[idx],
+                "limit": limit[idx], "since": pd.to_datetime(since[idx], unit="s", utc=True),
+            }))
+    out = pd.concat(events, ignore_index=True) if events else pd.DataFrame(columns=EVENT_COLUMNS)
+    return out.sort_values("ts", kind="stable").reset_index(drop=True), open_runs
+
+
+class StreamingEvaluator:
+    # Incremental mode: keeps, per elderly, just enough recent readings (the
+    # rules' lookback, plus any sustained run still open) to evaluate each new
+    # batch together with its history. An event is reported when it fires on a
+    # reading of the batch -- late ones included, evaluated against whatever
+    # history is still kept -- and only once per rule, elderly and run start
+    # (sustained) or reading time (drop), so a late reading inside a run that
+    # already fired doesn't fire it again.
+    def __init__(self, rules: list[dict]):
+        self.rules = rules
+        self.lookback = pd.Timedelta(seconds=lookback(rules))
+        self.buffer = pd.DataFrame()
+        self.emitted = {}  # (rule, elderly_id, run start or ts) -> ts of the event
+
+    @staticmethod
+    def event_keys(events: pd.DataFrame) -> list[tuple]:
+        anchor = events["since"].where(events["since"].notna(), events["ts"])
+        return list(zip(events["rule"], events["elderly_id"], anchor))
+
+    def feed(self, batch: pd.DataFrame) -> pd.DataFrame:
+        frame = pd.concat([self.buffer, batch], ignore_index=True) if not self.buffer.empty else batch
+        if frame.empty:
+            return pd.DataFrame(columns=EVENT_COLUMNS)
+        events, open_runs = evaluate(frame, self.rules)
+        fresh = set(zip(batch["elderly_id"].astype(str), batch["ts"]))
+        events = events[[k in fresh for k in zip(events["elderly_id"], events["ts"])]]
+        keys = self.event_keys(events) if not events.empty else []
+        new = [k not in self.emitted for k in keys]
+        events = events[new] if keys else events
+        self.emitted.update({k: ts for k, ts, n in zip(keys, pd.to_datetime(
+            pd.Series([k[2] for k in keys]), utc=True), new) if n})
+
+        latest = frame.groupby(frame["elderly_id"].astype(str))["ts"].max()
+        cutoff = latest - self.lookback
+        for eid, start in open_runs.items():
+            cutoff[eid] = min(cutoff[eid], pd.Timestamp(start, unit="s", tz="UTC"))
+        self.buffer = frame[frame["ts"] >= frame["elderly_id"].astype(str).map(cutoff)].reset_index(drop=True)
+        # Forget events whose readings have left the buffer; they can't recur.
+        self.emitted = {k: ts for k, ts in self.emitted.items()
+                        if k[1] not in cutoff.index or ts >= cutoff[k[1]] - self.lookback}
+        return events.reset_index(drop=True)
+
+
+def load_readings(db, start: dt.datetime, end: dt.datetime) -> pd.DataFrame:
+    docs = db["sensor_readings"].find({"ts": {"$gte": start, "$lt": end}},
+                                      {"_id": 0, "ts": 1, "elderly_id": 1, "device_id": 1, "vital_signs": 1})
+    return readings_frame(list(docs))
+
+
+def emit(events: pd.DataFrame, out_coll=None):
+    if events.empty:
+        return
+    sys.stdout.write(events.to_json(orient="records", lines=True, date_format="iso").rstrip("\n") + "\n")
+    sys.stdout.flush()
+    if out_coll is not None:
+        out_coll.insert_many(events.astype(object).where(events.notna(), None).to_dict("records"), ordered=False)
+
+
+def report(n: int, seconds: float, events: int):
+    print(f"rules: {n:,} readings in {seconds:.2f}s ({n / max(seconds, 1e-9):,.0f} readings/s), "
+          f"{events:,} events", file=sys.stderr)
+
+
+def backfill(db, rules: list[dict], start: dt.datetime, end: dt.datetime, chunk: dt.timedelta, out_coll=None):
+    # Chunks of `chunk`, each loaded with `lookback` seconds of history before
+    # it; events are kept only for readings inside the chunk itself.
+    back = dt.timedelta(seconds=lookback(rules))
+    total_n, total_s, total_events, c = 0, 0.0, 0, start
+    while c < end:
+        df = load_readings(db, c - back, min(c + chunk, end))
+        t0 = time.perf_counter()
+        events, _ = evaluate(df, rules)
+        events = events[events["ts"] >= pd.Timestamp(c)] if not events.empty else events
+        total_s += time.perf_counter() - t0
+        total_n += len(df)
+        total_events += len(events)
+        emit(events, out_coll)
+        c += chunk
+    report(total_n, total_s, total_events)
+
+
+class ReadingCursor:
+    # New sensor_readings for `stream`, oldest first. Readings with an ObjectId
+    # _id (what the driver assigns) are followed by _id, so readings that
+    # arrive late or share a timestamp are picked up too. Any other _id -- the
+    # bundled dump's hex strings, or dump-shaped lines replayed by ingest.py --
+    # says nothing about insertion order, so those readings are followed by ts.
+    # Both windows reach back `late` seconds and skip readings already fed:
+    # ObjectIds come from the writers' clocks and a retried ingest batch keeps
+    # its old ones. A reading that lands later than that is missed.
+    def __init__(self, coll, late: float):
+        self.coll = coll
+        self.late = dt.timedelta(seconds=late)
+        self.seen = {}  # _id -> what it was ordered by (the ObjectId, or ts)
+        last = coll.find_one({"_id": {"$type": "objectId"}}, {"_id": 1}, sort=[("_id", -1)])
+        self.newest_id = last["_id"] if last else None
+        last = coll.find_one({"_id": {"$not": {"$type": "objectId"}}, "ts": {"$type": "date"}}, {"ts": 1},
+                             sort=[("ts", -1)])
+        self.newest_ts = last["ts"] if last else None
+        self.mark(self.pending())  # start from now, like the evaluator
+
+    def pending(self) -> list[tuple]:
+        # (_id, order key) of the readings not fed yet.
+        by_id = {"$type": "objectId"}
+        if self.newest_id is not None:
+            by_id["$gt"] = ObjectId.from_datetime(self.newest_id.generation_time - self.late)
+        by_ts = {"$type": "date"}
+        if self.newest_ts is not None:
+            by_ts["$gt"] = self.newest_ts - self.late
+        out = [(d["_id"], d["_id"]) for d in self.coll.find({"_id": by_id}, {"_id": 1}).sort("_id", 1)]
+        out += [(d["_id"], d["ts"]) for d in self.coll.find(
+            {"_id": {"$not": {"$type": "objectId"}}, "ts": by_ts}, {"_id": 1, "ts": 1}).sort("ts", 1)]
+        return [(i, k) for i, k in out if i not in self.seen]
+
+    def mark(self, fed: list[tuple]):
+        for i, k in fed:
+            self.seen[i] = k
+            if isinstance(k, ObjectId):
+                self.newest_id = max(k, self.newest_id) if self.newest_id is not None else k
+            else:
+                self.newest_ts = max(k, self.newest_ts) if self.newest_ts is not None else k
+        # Forget what fell out of both windows; the queries can't return it again.
+        id_floor = ObjectId.from_datetime(self.newest_id.generation_time - self.late) if self.newest_id else None
+        ts_floor = self.newest_ts - self.late if self.newest_ts is not None else None
+        self.seen = {i: k for i, k in self.seen.items()
+                     if (k > id_floor if isinstance(k, ObjectId) else k > ts_floor)}
+
+
+def stream(db, rules: list[dict], poll: float, out_coll=None, source=None, max_batch: int = 5000,
+           late: float = 300):
+    # Each poll feeds at most `max_batch` new readings (see ReadingCursor), so a
+    # backlog after downtime is worked through in chunks.
+    ev = StreamingEvaluator(rules)
+    n, secs, count = 0, 0.0, 0
+    coll = db["sensor_readings"]
+    cursor = ReadingCursor(coll, late) if source is None else None
+    try:
+        while True:
+            if source is not None:
+                docs = [d for _, d in zip(range(max_batch), source)]
+                if not docs:
+                    break
+            else:
+                fed = cursor.pending()[:max_batch]
+                if not fed:
+                    time.sleep(poll)
+                    continue
+                docs = list(coll.find({"_id": {"$in": [i for i, _ in fed]}, "ts": {"$type": "date"}}, {"_id": 0}))
+                cursor.mark(fed)
+                if not docs:
+                    continue
+            t0 = time.perf_counter()
+            events = ev.feed(readings_frame(docs))
+            secs += time.perf_counter() - t0
+            n += len(docs)
+            count += len(events)
+            emit(events, out_coll)
+            report(n, secs, count)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Evaluate vital-sign threshold rules over sensor_readings.")
+    p.add_argument("--mongo-uri", default=CONFIG["mongo"]["uri"])
+    p.add_argument("--mongo-db", default=CONFIG["mongo"]["db_name"])
+    p.add_argument("--rules", metavar="FILE", help="JSON list of rules (default: built-in rules)")
+    p.add_argument("--to-collection", metavar="NAME", help="also insert events into this Mongo collection")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("show", help="print the active rules")
+    b = sub.add_parser("backfill", help="evaluate stored readings")
+    b.add_argument("--days", type=int, default=7)
+    b.add_argument("--chunk-days", type=float, default=1.0)
+    s = sub.add_parser("stream", help="evaluate new readings as they arrive")
+    s.add_argument("--poll", type=float, default=5.0, help="seconds between polls of sensor_readings")
+    s.add_argument("--stdin", action="store_true", help="read JSON lines readings from stdin instead")
+    s.add_argument("--max-batch", type=int, default=5000, help="readings evaluated per poll at most")
+    s.add_argument("--late-window", type=float, default=300,
+                   help="seconds a reading may take to land after its _id was made (default: %(default)s)")
+    args = p.parse_args(argv)
+
+    rules = DEFAULT_RULES
+    if args.rules:
+        with open(args.rules, encoding="utf-8") as fh:
+            rules = json.load(fh)
+    if args.cmd == "show":
+        print(json.dumps(rules, indent=2))
+        return
+
+    db = make_mongo_client(args.mongo_uri)[args.mongo_db]
+    out_coll = db[args.to_collection] if args.to_collection else None
+    if args.cmd == "backfill":
+        end = dt.datetime.now(dt.timezone.utc)
+        backfill(db, rules, end - dt.timedelta(days=args.days), end, dt.timedelta(days=args.chunk_days), out_coll)
+    else:
+        source = None
+        if args.stdin:
+            from ingest import read_lines
+            source = read_lines(sys.stdin)
+        stream(db, rules, args.poll, out_coll, source, args.max_batch, args.late_window)
+
+
+if __name__ == "__main__":
+    main()
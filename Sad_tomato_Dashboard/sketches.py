@@ -0,0 +1,312 @@
+import argparse
+import datetime as dt
+import math
+
+import pandas as pd
+from bson import ObjectId
+from pymongo import DeleteOne, ReplaceOne
+
+from queries import CONFIG
+
+# Mergeable per elderly / device / day summaries of every numeric
+# `vital_signs` field in sensor_readings, so percentile and distribution panels
+# read a few small documents instead of $bucket-ing every raw reading.
+#
+#   python sketches.py build [--rebuild]      # incremental: only days that received readings since the last build
+#   python sketches.py percentiles --field heart_rate --by elderly_id
+#
+# The summaries are DDSketches: values are counted in logarithmic bins whose
+# width is a fixed fraction of the value, so any quantile comes back within
+# RELATIVE_ACCURACY of the true value and two sketches merge by adding bin
+# counts. Histograms (the $bucket-style panels) must put a reading that sits
+# exactly on a boundary -- HR 50, HR 60 -- in the right bucket, which a
+# relative-error bin can't, so each sketch also keeps exact value -> count
+# pairs while a field has at most MAX_EXACT_VALUES distinct values (vitals are
+# integers or one-decimal readings, so in practice always).
+#
+# They live in the `vital_sketches` collection:
+#   {_id: "ELDERLY_1012|wb-016|2025-10-07", elderly_id, device_id, day,
+#    other_ids: 12, fields: {heart_rate: {...}, oxygen_level: {...}, ...}}
+# where other_ids counts the readings folded in whose _id is not an ObjectId
+# (see build_sketches).
+
+RELATIVE_ACCURACY = 0.01
+MAX_EXACT_VALUES = 2000
+# Readings with an ObjectId _id are found by _id (insertion order), so ones
+# that arrive late or share a timestamp are not missed. The watermark trails
+# the build start by this much, because ObjectIds from different clients are
+# only roughly ordered; re-folding a day is idempotent, so the overlap only
+# costs time.
+WATERMARK_LAG = dt.timedelta(minutes=5)
+SKETCH_COLLECTION = "vital_sketches"
+META_COLLECTION = "vital_sketches_meta"
+
+
+class DDSketch:
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY):
+        self.alpha = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0  # values <= 0 (vital signs never are, in practice)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.exact = {}  # value -> count; None once there are too many distinct values
+
+    def add(self, value: float, weight: int = 1):
+        if value > 0:
+            i = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[i] = self.bins.get(i, 0) + weight
+        else:
+            self.zero_count += weight
+        self.count += weight
+        self.sum += value * weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if self.exact is not None:
+            self.exact[value] = self.exact.get(value, 0) + weight
+            if len(self.exact) > MAX_EXACT_VALUES:
+                self.exact = None
+
+    def merge(self, other: "DDSketch"):
+        if other.alpha != self.alpha:
+            raise ValueError("can only merge sketches with the same relative accuracy")
+        for i, c in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + c
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if self.exact is None or other.exact is None:
+            self.exact = None
+        else:
+            for v, c in other.exact.items():
+                self.exact[v] = self.exact.get(v, 0) + c
+            if len(self.exact) > MAX_EXACT_VALUES:
+                self.exact = None
+        return self
+
+    def value(self, i: int) -> float:
+        # Representative value of bin i, within alpha of everything counted in it.
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return self.min
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                return min(max(self.value(i), self.min), self.max)
+        return self.max
+
+    def histogram(self, boundaries: list[float]) -> list[int]:
+        # Counts per [boundaries[k], boundaries[k+1]) plus one trailing bucket for
+        # everything outside, like $bucket's "default". Exact from the value
+        # counts; only a field with too many distinct values falls back to
+        # placing each bin by its representative value, where readings within
+        # RELATIVE_ACCURACY of a boundary may land on either side of it.
+        def bucket(v):
+            return next((k for k in range(len(boundaries) - 1) if boundaries[k] <= v < boundaries[k + 1]), -1)
+
+        counts = [0] * len(boundaries)
+        if self.exact is not None:
+            for v, c in self.exact.items():
+                counts[bucket(v)] += c
+            return counts
+        for i, c in self.bins.items():
+            counts[bucket(self.value(i))] += c
+        if self.zero_count:
+            k = 0 if boundaries and boundaries[0] <= 0 < boundaries[1] else -1
+            counts[k] += self.zero_count
+        return counts
+
+    def to_dict(self) -> dict:
+        return {"a": self.alpha, "n": self.count, "z": self.zero_count, "sum": self.sum,
+                "min": self.min, "max": self.max, "bins": {str(i): c for i, c in self.bins.items()},
+                "v": [[v, c] for v, c in self.exact.items()] if self.exact is not None else None}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "DDSketch":
+        s = cls(d["a"])
+        s.count, s.zero_count, s.sum, s.min, s.max = d["n"], d["z"], d["sum"], d["min"], d["max"]
+        s.bins = {int(i): c for i, c in d["bins"].items()}
+        s.exact = {v: c for v, c in d["v"]} if d.get("v") is not None else None
+        return s
+
+
+def reading_values(vital_signs: dict) -> dict:
+    # Numeric vitals as they are; "120/80" blood pressure split in two.
+    out = {}
+    for k, v in (vital_signs or {}).items():
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[k] = v
+        elif k == "blood_pressure" and isinstance(v, str) and "/" in v:
+            sys_, _, dia = v.partition("/")
+            try:
+                out["blood_pressure_systolic"], out["blood_pressure_diastolic"] = float(sys_), float(dia.split()[0])
+            except (ValueError, IndexError):
+                pass
+    return out
+
+
+def day_key(doc: dict) -> tuple:
+    return doc.get("elderly_id"), doc.get("device_id"), doc["ts"].strftime("%Y-%m-%d")
+
+
+def fold(docs, keep=None) -> tuple[dict, dict]:
+    # (elderly_id, device_id, day) -> {field: DDSketch} for the given readings,
+    # and per key [readings folded in, how many of them had a non-ObjectId _id].
+    out, counts = {}, {}
+    for doc in docs:
+        key = day_key(doc)
+        if keep is not None and key not in keep:
+            continue
+        fields = out.setdefault(key, {})
+        for field, v in reading_values(doc.get("vital_signs")).items():
+            fields.setdefault(field, DDSketch()).add(v)
+        c = counts.setdefault(key, [0, 0])
+        c[0] += 1
+        c[1] += not isinstance(doc.get("_id"), ObjectId)
+    return out, counts
+
+
+def other_id_changes(db) -> set:
+    # Keys whose readings with a non-ObjectId _id -- the bundled dump's hex
+    # strings, dump-shaped lines replayed by ingest.py -- no longer match what
+    # their stored sketch folded in. Those _ids carry no insertion order, so
+    # they are counted per key instead of compared with a watermark.
+    raw = {(g["_id"].get("e"), g["_id"].get("d"), g["_id"]["day"]): g["n"] for g in db["sensor_readings"].aggregate([
+        {"$match": {"_id": {"$not": {"$type": "objectId"}}, "ts": {"$type": "date"}}},
+        {"$group": {"_id": {"e": "$elderly_id", "d": "$device_id",
+                            "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$ts"}}},
+                    "n": {"$sum": 1}}},
+    ])}
+    stored = {day_key({**s, "ts": s["day"]}): s.get("other_ids", 0) for s in db[SKETCH_COLLECTION].find(
+        {}, {"_id": 0, "elderly_id": 1, "device_id": 1, "day": 1, "other_ids": 1})}
+    return {k for k in raw.keys() | stored.keys() if raw.get(k, 0) != stored.get(k, 0)}
+
+
+def build_sketches(db, rebuild: bool = False) -> int:
+    # Rebuilds the sketch of every (elderly, device, day) that received readings
+    # since the last build -- past the _id watermark, or per other_id_changes --
+    # from all of that day's readings, and replaces the stored one. Nothing is
+    # merged into stored sketches, so a run that dies before saving its
+    # watermark is simply repeated without double counting.
+    meta = db[META_COLLECTION].find_one({"_id": "sensor_readings"})
+    started = dt.datetime.now(dt.timezone.utc)
+    readings = db["sensor_readings"]
+    projection = {"ts": 1, "elderly_id": 1, "device_id": 1, "vital_signs": 1}
+    if rebuild or not meta or "last_id" not in meta:
+        db[SKETCH_COLLECTION].delete_many({})
+        sketches, counts = fold(readings.find({"ts": {"$type": "date"}}, projection))
+        affected = set()
+    else:
+        new = readings.find({"_id": {"$gt": meta["last_id"]}, "ts": {"$type": "date"}},
+                            {"_id": 0, "ts": 1, "elderly_id": 1, "device_id": 1})
+        affected = {day_key(d) for d in new} | other_id_changes(db)
+        sketches, counts = {}, {}
+        for day in sorted({k[2] for k in affected}):
+            start = dt.datetime.strptime(day, "%Y-%m-%d")
+            day_sketches, day_counts = fold(readings.find(
+                {"ts": {"$gte": start, "$lt": start + dt.timedelta(days=1)}}, projection), keep=affected)
+            sketches.update(day_sketches)
+            counts.update(day_counts)
+
+    ops = []
+    for (elderly_id, device_id, day), fields in sketches.items():
+        _id = f"{elderly_id}|{device_id}|{day}"
+        ops.append(ReplaceOne({"_id": _id}, {
+            "_id": _id, "elderly_id": elderly_id, "device_id": device_id,
+            "day": dt.datetime.strptime(day, "%Y-%m-%d"), "other_ids": counts[elderly_id, device_id, day][1],
+            "fields": {f: s.to_dict() for f, s in fields.items()},
+        }, upsert=True))
+    # Affected keys with no readings left.
+    ops += [DeleteOne({"_id": f"{e}|{d}|{day}"}) for e, d, day in affected - sketches.keys()]
+    if ops:
+        db[SKETCH_COLLECTION].bulk_write(ops, ordered=False)
+        db[SKETCH_COLLECTION].create_index([("day", -1)])
+    db[META_COLLECTION].replace_one({"_id": "sensor_readings"}, {
+        "_id": "sensor_readings", "last_id": ObjectId.from_datetime(started - WATERMARK_LAG),
+    }, upsert=True)
+    return sum(c[0] for c in counts.values())
+
+
+def merge_docs(docs: list[dict], field: str, by: str | None) -> dict:
+    merged = {}
+    for doc in docs:
+        d = (doc.get("fields") or {}).get(field)
+        if d:
+            key = doc.get(by) if by else field
+            if key in merged:
+                merged[key].merge(DDSketch.from_dict(d))
+            else:
+                merged[key] = DDSketch.from_dict(d)
+    return merged
+
+
+def sketch_frame(docs: list[dict], spec: dict) -> pd.DataFrame:
+    # spec: {"field": ..., "by": "elderly_id" | "device_id" | None,
+    #        "quantiles": [0.05, 0.5, 0.95]}  -> one row per group
+    #   or  {"field": ..., "boundaries": [...], "labels": [...]} -> one row per bucket
+    merged = merge_docs(docs, spec["field"], spec.get("by"))
+    if not merged:
+        return pd.DataFrame()
+    if "boundaries" in spec:
+        total = DDSketch()
+        for s in merged.values():
+            total.merge(s)
+        b = spec["boundaries"]
+        labels = spec.get("labels") or [f"{lo}-{hi}" for lo, hi in zip(b, b[1:])]
+        counts = total.histogram(b)
+        rows = [{"range": label, "reading_count": c} for label, c in zip(labels + ["other"], counts)]
+        return pd.DataFrame([r for r in rows if r["reading_count"]])
+
+    qs = spec.get("quantiles", [0.05, 0.5, 0.95])
+    rows = []
+    for key, s in sorted(merged.items(), key=lambda kv: str(kv[0])):
+        row = {spec.get("by") or "field": key, "readings": s.count}
+        row.update({f"p{round(q * 100):g}": round(s.quantile(q), 1) for q in qs})
+        row.update({"min": s.min, "max": s.max, "mean": round(s.sum / s.count, 1)})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Build and query vital-sign sketches.")
+    p.add_argument("--mongo-uri", default=CONFIG["mongo"]["uri"])
+    p.add_argument("--mongo-db", default=CONFIG["mongo"]["db_name"])
+    sub = p.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="fold new sensor_readings into the daily sketches")
+    b.add_argument("--rebuild", action="store_true", help="drop the sketches and rebuild from all readings")
+    pc = sub.add_parser("percentiles", help="print percentiles merged from the stored sketches")
+    pc.add_argument("--field", default="heart_rate")
+    pc.add_argument("--by", default="elderly_id", help="elderly_id, device_id or '' for one overall row")
+    pc.add_argument("--days", type=int, help="only the last N days")
+    args = p.parse_args(argv)
+
+    from backend import make_mongo_client  # not at the top: backend imports this module
+
+    db = make_mongo_client(args.mongo_uri)[args.mongo_db]
+    if args.cmd == "build":
+        n = build_sketches(db, rebuild=args.rebuild)
+        print(f"re-folded {n:,} readings; {db[SKETCH_COLLECTION].estimated_document_count():,} sketches stored")
+    else:
+        match = {}
+        if args.days:
+            # Whole days, like the dashboard's sketch panels (see window_stages).
+            cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=args.days)
+            match["day"] = {"$gte": cutoff.replace(hour=0, minute=0, second=0, microsecond=0)}
+        docs = list(db[SKETCH_COLLECTION].find(match, {"_id": 0, "elderly_id": 1, "device_id": 1,
+                                                         f"fields.{args.field}": 1}))
+        print(sketch_frame(docs, {"field": args.field, "by": args.by or None}).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
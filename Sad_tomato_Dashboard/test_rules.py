@@ -0,0 +1,144 @@
+import datetime as dt
+import io
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+
+from bson import ObjectId
+
+import rules
+
+# python -m unittest test_rules   (from this directory; no database needed)
+
+BASE = dt.datetime(2025, 10, 1, 8, 0)
+
+
+class FakeCollection:
+    # Just the find / find_one subset ReadingCursor and stream() use, with
+    # Mongo's comparison rule that $gt never matches across BSON types.
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    @staticmethod
+    def matches(value, cond) -> bool:
+        if not isinstance(cond, dict):
+            return value == cond
+        for op, arg in cond.items():
+            if op == "$type":
+                ok = isinstance(value, {"objectId": ObjectId, "date": dt.datetime}[arg])
+            elif op == "$gt":
+                ok = type(value) is type(arg) and value > arg
+            elif op == "$in":
+                ok = value in arg
+            elif op == "$not":
+                ok = not FakeCollection.matches(value, arg)
+            else:
+                raise NotImplementedError(op)
+            if not ok:
+                return False
+        return True
+
+    def select(self, filter_, projection):
+        out = []
+        for d in self.docs:
+            if not all(self.matches(d.get(k), c) for k, c in filter_.items()):
+                continue
+            if any(projection.values()):  # inclusion; _id comes along unless excluded
+                keep = {k for k, v in projection.items() if v} | ({"_id"} if projection.get("_id", 1) else set())
+                out.append({k: v for k, v in d.items() if k in keep})
+            else:
+                out.append({k: v for k, v in d.items() if k not in projection})
+        return out
+
+    def find(self, filter_=None, projection=None):
+        return FakeCursor(self.select(filter_ or {}, projection or {}))
+
+    def find_one(self, filter_=None, projection=None, sort=None):
+        docs = self.find(filter_, projection)
+        if sort:
+            docs = docs.sort(*sort[0])
+        return docs[0] if docs else None
+
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda d: d[key], reverse=direction < 0))
+
+
+def reading(_id, seconds: float, hr: float = 80.0, elderly: str = "ELDERLY_1001") -> dict:
+    return {"_id": _id, "ts": BASE + dt.timedelta(seconds=seconds), "device_id": "wb-001", "elderly_id": elderly,
+            "vital_signs": {"heart_rate": hr, "oxygen_level": 97, "body_temperature": 36.8}, "is_abnormal": False}
+
+
+def hex_id(i: int) -> str:
+    # The bundled dump's _ids: 24 hex characters, stored as strings, in no particular order.
+    return f"{(i * 2654435761) % 16 ** 24:024x}"
+
+
+class ReadingCursorTest(unittest.TestCase):
+    def test_string_ids_are_followed_by_ts(self):
+        coll = FakeCollection(reading(hex_id(i), i * 60) for i in range(10))
+        cursor = rules.ReadingCursor(coll, late=300)
+        self.assertEqual(cursor.pending(), [])  # what was there at start is skipped
+
+        coll.docs += [reading(hex_id(100), 700), reading(hex_id(101), 700),  # same ts
+                      reading(hex_id(102), 660)]  # late, behind the newest one
+        fed = cursor.pending()
+        self.assertEqual({i for i, _ in fed}, {hex_id(100), hex_id(101), hex_id(102)})
+        cursor.mark(fed)
+        self.assertEqual(cursor.pending(), [])
+
+        coll.docs.append(reading(hex_id(103), 690))  # late again, inside the window
+        self.assertEqual([i for i, _ in cursor.pending()], [hex_id(103)])
+
+    def test_object_and_string_ids_together(self):
+        coll = FakeCollection([reading(hex_id(1), 0), reading(ObjectId.from_datetime(BASE), 0)])
+        cursor = rules.ReadingCursor(coll, late=300)
+        self.assertEqual(cursor.pending(), [])
+        new_oid = ObjectId()
+        coll.docs += [reading(new_oid, 120), reading(hex_id(2), 120)]
+        self.assertEqual({i for i, _ in cursor.pending()}, {new_oid, hex_id(2)})
+
+
+class StreamTest(unittest.TestCase):
+    def run_stream(self, coll, arrivals: list[list[dict]], max_batch: int) -> list[int]:
+        # Feeds the readings of arrivals[k] on the k-th idle poll; returns the
+        # size of every batch the evaluator got.
+        batches = []
+        feed = rules.StreamingEvaluator.feed
+        waits = iter(arrivals)
+
+        def fake_feed(ev, batch):
+            batches.append(len(batch))
+            return feed(ev, batch)
+
+        def fake_sleep(_):
+            try:
+                coll.docs.extend(next(waits))
+            except StopIteration:
+                raise KeyboardInterrupt
+
+        with mock.patch.object(rules.StreamingEvaluator, "feed", fake_feed), \
+                mock.patch.object(rules.time, "sleep", fake_sleep), \
+                redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            rules.stream({"sensor_readings": coll}, rules.DEFAULT_RULES, poll=1, max_batch=max_batch)
+        return batches
+
+    def test_restored_dump_with_string_ids(self):
+        coll = FakeCollection(reading(hex_id(i), i * 60) for i in range(20))
+        new = [reading(hex_id(100 + i), 1200 + i * 10, hr=130) for i in range(35)]
+        new += [reading(hex_id(200), 1250, hr=130), reading(hex_id(201), 1240, hr=130)]  # same ts / late
+        batches = self.run_stream(coll, [new], max_batch=10)
+        self.assertEqual(sum(batches), len(new))
+        self.assertTrue(all(b <= 10 for b in batches))
+
+    def test_readings_without_a_date_ts_are_skipped(self):
+        coll = FakeCollection()
+        bad = reading(hex_id(1), 0)
+        bad["ts"] = "2025-10-01T08:00:00"
+        batches = self.run_stream(coll, [[bad, reading(hex_id(2), 0)]], max_batch=10)
+        self.assertEqual(batches, [1])
+
+
+if __name__ == "__main__":
+    unittest.main()